@@ -34,6 +34,48 @@ class APIConfig:
     stop: Any = field(default=None)
     logit_bias: Dict[str, float] = field(default_factory=dict)
 
+    # The params below are not sent to the API. They control how
+    # our client paces its calls. A limit of 0 means no limit.
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+
+    # Responses can be cached on disk keyed by the prompt and this config.
+    # cache_mode is one of off, read_write or replay. In replay mode
+    # the API is never called and a cache miss is an error.
+    cache_mode: str = "off"
+    # This is the path from the main git dir.
+    cache_path: str = "experiments/completion_cache.sqlite"
+    cache_max_mb: int = 1024
+    # Sampled completions (temperature > 0) are different on every call.
+    # Only read them from the cache in read_write mode if this is True.
+    cache_sampled_completions: bool = False
+
+    # Used to estimate the spend in the telemetry summary
+    price_per_1k_tokens: float = 0.02
+    # How often the telemetry summary is logged and written
+    telemetry_interval_seconds: int = 60
+    # The tokens of the prompt and max_tokens must fit in this
+    context_window: int = 4097
+    # Prompt tokens are only estimated at 4 characters per token. Schema
+    # and SQL text has fewer characters per token so this fraction of the
+    # context window is left free in case the estimate is too low.
+    context_window_margin: float = 0.25
+
+# These APIConfig fields configure the client and must be
+# removed before the config is passed to openai.Completion.create
+CLIENT_ONLY_API_KEYS = (
+    'requests_per_minute',
+    'tokens_per_minute',
+    'cache_mode',
+    'cache_path',
+    'cache_max_mb',
+    'cache_sampled_completions',
+    'price_per_1k_tokens',
+    'telemetry_interval_seconds',
+    'context_window',
+    'context_window_margin',
+)
+
 @dataclass
 class GenerationConfig:
     """A prompt will be constructed like this. Anything capitalized
@@ -53,6 +95,18 @@ class GenerationConfig:
     table_prefix: str = ""
     # This is the path from the main git dir.
     data_output_dir: str = "data/generated_data"
+    # Pairs are written as jsonl (one pair per line) or as a json array
+    data_output_format: str = "jsonl"
+    # The API responses are written to the experiment dir as one json
+    # file per call (files) or one compressed archive per database (archive).
+    # Read an archive with lib.response_archive.ResponseArchiveReader
+    response_output_format: str = "archive"
+    # One of gzip or zstd. zstd needs the zstandard package
+    archive_compression: str = "gzip"
+    # Write output from a background thread while generating. At most
+    # max_pending_output records wait in memory to be written.
+    background_writer: bool = True
+    max_pending_output: int = 1000
     new_schema_few_shot_name: str = "schema_few_shot.txt"
     
     # These params control the few shot settings.
@@ -69,6 +123,72 @@ class GenerationConfig:
     n_generations_per_database: int = 1
     random_seed: int = 42
 
+    # The databases to generate for. An empty list is every database
+    # in the few_shot_prompts dir.
+    databases: List[str] = field(default_factory=list)
+    # When above 0 gen_sql schedules chains to the databases furthest
+    # below this number of valid pairs in the data output dir instead of
+    # running every prompt for every database. A pair is valid when inline
+    # validation marked it valid or, without inline validation, when
+    # validate_sql.py wrote it to syntax_correct_data.json. Pairs that were
+    # never validated do not count. No chain is started once
+    # request_budget requests or token_budget tokens (0 is unlimited)
+    # could be exceeded. A database gets at most max_units_per_database
+    # chains so one that keeps producing invalid or duplicate pairs is
+    # retired. 0 is twice the chains the target needs.
+    target_pairs_per_database: int = 0
+    request_budget: int = 0
+    token_budget: int = 0
+    max_units_per_database: int = 0
+
+    # chain makes n_generations_per_database calls per prompt. Each
+    # call has the previous outputs appended to the prompt.
+    # fan_out makes one call that samples n_generations_per_database
+    # choices from the same prompt.
+    generation_mode: str = "chain"
+    # Drop fan out samples with the same query
+    fan_out_dedupe: bool = True
+    # Added after the prompt in fan_out mode to ask for varied samples
+    diversity_hint: str = ""
+
+    # The spider sqlite databases used to validate and dedupe queries.
+    # This is the path from the main git dir.
+    database_dir: str = "data/spider/database"
+
+    # Run every generated query against its spider sqlite database while
+    # generating. Pairs are written with is_valid and error_msg.
+    inline_validation: bool = False
+    validation_workers: int = 4
+    validation_timeout_ms: int = 10000
+    # One of execute, prepare (only compile the query) or prepare_then_execute
+    validation_mode: str = "execute"
+    # What a gen_sql chain does once more than max_invalid_rate of its
+    # queries are invalid. One of none, stop (end the chain) or
+    # regenerate (call again for an invalid query up to max_regenerations times)
+    invalid_action: str = "none"
+    max_invalid_rate: float = 0.5
+    min_validated_before_action: int = 3
+    max_regenerations: int = 2
+
+    # Drop gen_sql queries that were already generated for their database.
+    # Queries are compared after parsing so aliases, case and whitespace
+    # do not matter. Existing pairs in the data output dir count as well
+    # when dedupe_against_existing is true.
+    dedupe_queries: bool = False
+    dedupe_against_existing: bool = True
+    # Stop the chains of a database once less than min_novelty_rate of
+    # its last novelty_window queries were new. 0 never stops a chain.
+    novelty_window: int = 20
+    min_novelty_rate: float = 0.0
+
+    # How long to sleep after the API returns an error before retrying
+    rate_limit_sleep_seconds: int = 61
+    service_unavailable_sleep_seconds: int = 60
+
+    # Each (database, prompt) pair is a chain of calls. Chains are
+    # independent so this many of them can run at the same time.
+    max_concurrent_chains: int = 1
+
     # These are the list of different prompts to use. They
     # Will be the last line of text given to the model.
     prompts: List[str] = field(default_factory=list)
@@ -78,6 +198,10 @@ class GenerationConfig:
     query_prefix: str = "SQL: "
     question_prefix: str = "Question: "
     n_few_shot_examples: int = 0
+    # Few shot examples are packed, best first, into what is left of the
+    # context window after max_tokens. A budget above 0 lowers the
+    # tokens a prompt may use, e.g. to leave room for a chain to grow.
+    prompt_token_budget: int = 0
 
 @dataclass
 class CodexGenerationConfig(GenerationConfig):
@@ -94,6 +218,21 @@ class CodexGenerationConfig(GenerationConfig):
     # https://beta.openai.com/playground/p/default-sql-translate?model=code-davinci-002
     use_commented_few_shot: bool = False
 
+    # How many prompts to send in a single request. The API returns
+    # the choices for every prompt in one response.
+    batch_size: int = 1
+
+    # Only keep the tables of the schema that the question mentions,
+    # and the tables joining them, to cut prompt tokens. The budget is
+    # at most schema_max_tables tables and schema_max_tokens tokens.
+    # 0 is no limit. Foreign keys are read from the databases in database_dir.
+    schema_pruning: bool = False
+    schema_max_tables: int = 0
+    schema_max_tokens: int = 0
+    # Also drop the columns of a kept table that the question does not
+    # mention. Primary and foreign key columns are always kept.
+    schema_prune_columns: bool = False
+
 @dataclass
 class EvaluationConfig:
     # All paths are from the main git dir
@@ -104,15 +243,45 @@ class EvaluationConfig:
     gold_key: str = "gold_sql"
     database_path: str = "data/spider/database"
     eval_output_fname: str = "results.csv"
+    # A predicted query that runs longer than this counts as an error
+    timeout_ms: int = 10000
 
 @dataclass
 class ExperimentConfig:
     api_cfg: APIConfig
     generation_cfg: GenerationConfig
 
+    # Path to the hydra run dir of an interrupted run. Work units
+    # in its journal are skipped. Path is from the main git dir
+    # unless it is absolute.
+    resume: str = ""
+
+    # Log the requests, tokens, cost and wall time the run would use
+    # without calling the API. Calls are assumed to take
+    # dry_run_latency_seconds each.
+    dry_run: bool = False
+    dry_run_latency_seconds: float = 2.0
+
+@dataclass
+class MockConfig:
+    "Settings for lib.mock_completion.MockCompletion"
+    # One of constant, uniform or lognormal
+    latency_distribution: str = "lognormal"
+    latency_mean_s: float = 1.0
+    latency_sigma: float = 0.5
+    # The fraction of calls that raise these errors
+    rate_limit_error_rate: float = 0.0
+    service_unavailable_rate: float = 0.0
+    random_seed: int = 42
+
+@dataclass
+class LoadTestConfig(ExperimentConfig):
+    mock: MockConfig = field(default_factory=MockConfig)
+
 cs = ConfigStore()
 cs.store(name="base_cfg", node=ExperimentConfig)
 cs.store(name="eval_cfg", node=EvaluationConfig)
+cs.store(name="load_test_base_cfg", node=LoadTestConfig)
 cs.store(group="api_cfg", name="api_base_cfg", node=APIConfig)
 cs.store(group="generation_cfg", name="codex_base_cfg", node=CodexGenerationConfig)
 cs.store(group="generation_cfg", name="generation_base_cfg", node=GenerationConfig)
\ No newline at end of file
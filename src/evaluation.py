@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import sys
 import json
-import signal
 import logging
 
 from typing import Dict, List
@@ -17,25 +16,10 @@ import pandas as pd
 from omegaconf import OmegaConf
 
 from src.config import EvaluationConfig
+from lib.sql_timeout import QueryTimeoutError, query_timeout
 
 logger = logging.getLogger("myLogger")
 
-class TimeoutError(Exception):
-    pass
-
-def timeout(func):
-    def _handle_timeout(signum, frame):
-        raise TimeoutError("SQL took more than 10 seconds. Marking Invalid.")
-    def wrapper(*a, **kw):
-        signal.signal(signal.SIGALRM, _handle_timeout)
-        signal.alarm(10)
-        try:
-            result = func(*a, **kw)
-        finally:
-            signal.alarm(0)
-        return result
-    return wrapper
-
 def tokenize(string):
     """This is a slight modification from the original spider code
     https://github.com/taoyds/spider/blob/master/process_sql.py
@@ -115,10 +99,10 @@ def get_alias_table(query: str) -> Dict[str, str]:
             alias_table[no_comma_alias] = select_stmt[i-1]
     return alias_table
 
-@timeout
-def get_pred_result(conn, query):
-    result = conn.query(query)
-    return result
+def get_pred_result(conn, query, timeout_ms: float):
+    # records fetches rows lazily so read them all inside the timeout
+    with query_timeout(conn, timeout_ms):
+        return conn.query(query).as_dict()
 
 # TODO: Implement hardness scores from spider
 def evaluate(cfg: EvaluationConfig, input_path: Path, db_dir: Path):
@@ -145,8 +129,8 @@ def evaluate(cfg: EvaluationConfig, input_path: Path, db_dir: Path):
         try:
             logger.debug(f'I am the DB: {db_name} I am the query: {pred}')
             # pred_return = conn.query(pred).as_dict()
-            pred_return = get_pred_result(conn, pred).as_dict()
-        except TimeoutError as e:
+            pred_return = get_pred_result(conn, pred, cfg.timeout_ms)
+        except QueryTimeoutError as e:
             logger.warning(e)
             error = 1
             is_correct = 0
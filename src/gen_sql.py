@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 import sys
-import time
+import json
+import math
 import logging
+import threading
 
-from typing import Dict
+from typing import Callable, Dict, List, Optional
 from collections import deque
 from pathlib import Path
 PARENT_DIR = Path(__file__, '../..').resolve()
 sys.path.append(str(PARENT_DIR))
 
 import hydra
-import openai
 
 from omegaconf import OmegaConf
 from openai.error import RateLimitError, ServiceUnavailableError
@@ -20,47 +21,313 @@ from src.config import (
     get_output_dir, get_exp_time
 )
 
-from lib.create_few_shot_prompt import generate_prompts
-from lib.write_output import OutputManager
+from lib.create_few_shot_prompt import PATH_TO_FEW_SHOT, generate_prompts
+from lib.write_output import OutputManager, BackgroundWriter, raise_on_sigterm
+from lib.completion_client import CompletionClient
+from lib.concurrency import run_concurrently
+from lib.journal import GenerationJournal
+from lib.sql_validator import SQLValidator
+from lib.dedup_index import DedupIndex, canonicalize_query
+from lib.data_files import iter_data_file
+from lib.scheduler import GenerationScheduler, count_valid_pairs, default_max_units
+from lib.prompt_assembler import prompt_token_budget, usable_context_window
+from lib.tokens import estimate_tokens
+from lib.dry_run import mean_output_tokens, plan_gpt_run, add_time_and_cost, log_plan
 
 logger = logging.getLogger("myLogger")
 
-def generate_sql(api_cfg: APIConfig, gen_cfg: GenerationConfig, db_prompts: Dict[str, Dict[str, str]]):
+def generate_sql(
+    api_cfg: APIConfig, gen_cfg: GenerationConfig,
+    db_prompts: Dict[str, Dict[str, str]], resume_dir: Optional[Path] = None,
+    backend: Optional[Callable] = None
+) -> OutputManager:
     data_output_dir = PARENT_DIR / gen_cfg.data_output_dir
-    output_queue = deque()
-    api_cfg = OmegaConf.to_container(api_cfg)
     
     # Create output manager object to write output to disk
     output_dir = get_output_dir()
+    client = CompletionClient.from_api_cfg(api_cfg, backend, output_dir)
     gpt_response_dir = output_dir / "gpt_input_output"
     gpt_response_dir.mkdir()
 
+    # The journal records every finished generation with the prompt
+    # text it produced so an interrupted chain can continue from it.
+    journal = GenerationJournal(output_dir)
+    finished = {}
+    if resume_dir is not None:
+        for unit in journal.resume_from(resume_dir):
+            key = (unit['db_name'], unit['itr'])
+            # A regenerated call is journaled again with the same i
+            if key not in finished or unit['i'] >= finished[key]['i']:
+                finished[key] = unit
+
     exp_time = get_exp_time()
     output_manager = OutputManager(
         exp_time=exp_time,
         exp_output_dir=gpt_response_dir,
-        data_output_dir=data_output_dir
+        data_output_dir=data_output_dir,
+        journal=journal,
+        data_format=gen_cfg.data_output_format,
+        exp_format=gen_cfg.response_output_format,
+        archive_compression=gen_cfg.archive_compression
     )
+    # Queries are validated in the background. The output manager waits
+    # for the result before it writes the pair.
+    validator = None
+    if gen_cfg.inline_validation:
+        validator = SQLValidator(
+            PARENT_DIR / gen_cfg.database_dir,
+            gen_cfg.validation_workers, gen_cfg.validation_timeout_ms,
+            gen_cfg.validation_mode
+        )
+    if gen_cfg.invalid_action not in ('none', 'stop', 'regenerate'):
+        raise ValueError(
+            f"Invalid action {gen_cfg.invalid_action} is not valid.",
+            "Invalid action must be one of [none, stop, regenerate]."
+        )
+    # Every query is checked against the queries generated for its database
+    dedup_index = None
+    if gen_cfg.dedupe_queries:
+        dedup_index = DedupIndex(PARENT_DIR / gen_cfg.database_dir, gen_cfg.novelty_window)
+        if gen_cfg.dedupe_against_existing:
+            for db_name in db_prompts:
+                db_dir = data_output_dir / db_name
+                dedup_index.seed(db_name, (
+                    pair['query']
+                    for fpath in sorted(db_dir.glob('[0-9]*.json*'))
+                    for pair in iter_data_file(fpath)
+                ))
+    # Send chains to the databases with the fewest valid pairs
+    scheduler = None
+    if gen_cfg.target_pairs_per_database > 0:
+        if not gen_cfg.inline_validation:
+            logger.warning(
+                'Only validated pairs count towards target_pairs_per_database. '
+                'Without inline_validation the pairs of this run are not counted.'
+            )
+        is_fan_out = gen_cfg.generation_mode == 'fan_out'
+        scheduler = GenerationScheduler(
+            count_valid_pairs(data_output_dir, [db for db, prompts in db_prompts.items() if prompts]),
+            target=gen_cfg.target_pairs_per_database,
+            pairs_per_unit=gen_cfg.n_generations_per_database,
+            requests_per_unit=1 if is_fan_out else gen_cfg.n_generations_per_database,
+            request_budget=gen_cfg.request_budget,
+            token_budget=gen_cfg.token_budget,
+            max_units_per_database=gen_cfg.max_units_per_database
+        )
+    if gen_cfg.background_writer:
+        output_queue = BackgroundWriter(output_manager, gen_cfg.max_pending_output)
+    else:
+        output_queue = deque()
+
+    def write_output() -> float:
+        if gen_cfg.background_writer:
+            return output_queue.flush()
+        return output_manager.write_output(output_queue)
+
+    def close_output():
+        seconds_spent = write_output()
+        logger.debug(f'Spent: {seconds_spent} seconds writing output')
+        if gen_cfg.background_writer:
+            output_queue.close()
+        output_manager.close()
+        if validator is not None:
+            validator.close()
+        if dedup_index is not None:
+            summary = dedup_index.summary()
+            logger.info(f"Kept {summary['n_new']} of {summary['n_seen']} generated queries as new")
+            with open(output_dir / 'novelty.json', 'w') as f:
+                json.dump(summary, f, indent=4)
+        journal.close()
+        client.close()
+
+    def record_usage(db_name: str, itr: int, response: Dict):
+        if scheduler is not None:
+            scheduler.record_request(db_name, itr, response['usage']['total_tokens'])
+
+    def submit_pair(db_name: str, itr: int, pair: Dict, key: str):
+        """Queue a pair to be written with its validation and count it
+        towards the database once it is known to be valid.
+        """
+        validation = None
+        if validator is not None:
+            validation = validator.submit(db_name, pair['query'])
+            pair['validation'] = validation
+            if scheduler is not None:
+                validation.add_done_callback(
+                    lambda future: scheduler.record_pair(db_name, itr, future.result()['is_valid'])
+                )
+        elif scheduler is not None:
+            # An unvalidated pair does not count towards the target
+            scheduler.record_pair(db_name, itr, is_valid=False)
+        output_queue.append({(db_name, 'pair', key): pair})
+        return validation
 
     def call_model(
         prompt: str, given_prompt: str, difficulty: str,
-        itr: int, i: int, db_name: str
+        itr: int, i: int, db_name: str, attempt: int = 0
     ):
-        response = openai.Completion.create(
-            prompt=prompt,
-            **api_cfg
-        )
+        labels = {'db_id': db_name, 'prompt': given_prompt, 'itr': itr, 'i': i}
+        key = f'{itr}_{i}'
+        if attempt:
+            labels['attempt'] = attempt
+            key = f'{key}_retry{attempt}'
+        response = client.create(prompt, labels)
+        record_usage(db_name, itr, response)
         result = parse_response(response, gen_cfg.query_prefix)
         result['input'] = prompt
         # Append the output from the model to the prompt
         prompt += f"{result['output']}\n\n{gen_cfg.suffix}"
         # Save the gpt response json, the input/output/query/question
         # To the experiment directory so we keep track of everything
-        output_queue.append({(db_name, 'response', f'{itr}_{i}'): response})
-        output_queue.append({(db_name, 'input_output', f'{itr}_{i}'): result})
+        output_queue.append({(db_name, 'response', key): response})
+        output_queue.append({(db_name, 'input_output', key): result})
+        if dedup_index is not None and not dedup_index.add(db_name, result['query']):
+            logger.debug(f'Dropping a duplicate query for {db_name} in iteration {itr}: {result["query"]}')
+            output_queue.append({(db_name, 'journal', key):
+                {'db_name': db_name, 'itr': itr, 'i': i, 'prompt': given_prompt, 'text': prompt}
+            })
+            return prompt, None
         # Save the question query pair directly to the data dir
-        output_queue.append({(db_name, 'pair', f'{itr}_{i}'): 
-            {
+        pair = {
+            'db_id': db_name,
+            'question': result['question'],
+            'query': result['query'],
+            'n_generation': i,
+            'prompt': given_prompt,
+            'difficulty_of_few_shot': difficulty
+        }
+        validation = submit_pair(db_name, itr, pair, key)
+        output_queue.append({(db_name, 'journal', key):
+            {'db_name': db_name, 'itr': itr, 'i': i, 'prompt': given_prompt, 'text': prompt}
+        })
+        return prompt, validation
+
+    def call_with_retry(func: Callable, *args):
+        try:
+            return func(*args)
+        except RateLimitError as e:
+            if str(e) == "You exceeded your current quota, please check your plan and billing details.":
+                logger.error('We ran out of tokens :(')
+                raise e
+            logger.error('We have hit our rate limit. Writing output then sleeping.')
+            seconds_spent = write_output()
+            logger.debug(f'Spent: {seconds_spent} seconds writing output')
+            client.backoff(max(0, gen_cfg.rate_limit_sleep_seconds - seconds_spent), 'rate_limit_error')
+            return func(*args)
+        except ServiceUnavailableError as e:
+            logger.error(e)
+            logger.error('The service was unavailable sleeping for a minute.')
+            client.backoff(gen_cfg.service_unavailable_sleep_seconds, 'service_unavailable')
+            return func(*args)
+
+    def novelty_collapsed(db_name: str) -> bool:
+        if dedup_index is None or gen_cfg.min_novelty_rate <= 0:
+            return False
+        novelty_rate = dedup_index.recent_novelty_rate(db_name)
+        if novelty_rate is None or novelty_rate >= gen_cfg.min_novelty_rate:
+            return False
+        if scheduler is not None:
+            scheduler.exclude(db_name)
+        return True
+
+    def run_chain(db_name: str, itr: int, prompt: Dict[str, str]):
+        # Every call in a chain extends the prompt with the previous
+        # output so the calls inside of a chain must stay in order.
+        diff = prompt["difficulty_of_few_shot"]
+        given_prompt = prompt["prompt"]
+        text = prompt["text"]
+        start = 0
+        if (db_name, itr) in finished:
+            unit = finished[(db_name, itr)]
+            if unit['prompt'] != given_prompt:
+                logger.warning(
+                    f'The resumed chain for db: {db_name} iteration: {itr} '
+                    f'used the prompt: {unit["prompt"]} not: {given_prompt}'
+                )
+            text = unit['text']
+            start = unit['i'] + 1
+            if start >= gen_cfg.n_generations_per_database:
+                return
+            logger.info(f'Resuming db: {db_name} iteration: {itr} from generation: {start}')
+        logger.info(
+            'Generating SQL for db: {} with few shot difficulty: {} and prompt: {}'
+            .format(db_name, diff, given_prompt)
+        )
+        n_validated, n_invalid = 0, 0
+        for i in range(start, gen_cfg.n_generations_per_database):
+            if stop_event.is_set():
+                return
+            logger.debug(f'I am prompt for {db_name} in iteration {itr}\n{text}')
+            # The API rejects a prompt that leaves no room for max_tokens.
+            # The token count is an estimate so the window has a margin.
+            if estimate_tokens(text) + api_cfg.max_tokens > usable_context_window(api_cfg):
+                logger.warning(
+                    f'Ending the chain for db: {db_name} iteration: {itr} at generation {i}. '
+                    f'The prompt no longer fits in the context window.'
+                )
+                return
+            new_text, validation = call_with_retry(call_model, text, given_prompt, diff, itr, i, db_name)
+            if novelty_collapsed(db_name):
+                logger.warning(
+                    f'Stopping the chain for db: {db_name} iteration: {itr} after {i + 1} '
+                    f'generations. Too few of its recent queries were new.'
+                )
+                return
+            if validation is None or gen_cfg.invalid_action == 'none':
+                text = new_text
+                continue
+
+            # Only wait on the validation when the chain acts on it
+            is_valid = validation.result()['is_valid']
+            attempt = 0
+            while (
+                not is_valid and gen_cfg.invalid_action == 'regenerate'
+                and attempt < gen_cfg.max_regenerations and not stop_event.is_set()
+            ):
+                attempt += 1
+                logger.debug(f'Regenerating invalid SQL for {db_name} in iteration {itr} generation {i}')
+                new_text, validation = call_with_retry(
+                    call_model, text, given_prompt, diff, itr, i, db_name, attempt
+                )
+                if validation is None:
+                    # The regenerated query was a duplicate and was dropped
+                    break
+                is_valid = validation.result()['is_valid']
+            text = new_text
+            n_validated += 1
+            n_invalid += not is_valid
+            if (
+                gen_cfg.invalid_action == 'stop'
+                and n_validated >= gen_cfg.min_validated_before_action
+                and n_invalid / n_validated > gen_cfg.max_invalid_rate
+            ):
+                logger.warning(
+                    f'Stopping the chain for db: {db_name} iteration: {itr} after {n_validated} '
+                    f'generations. {n_invalid} of its queries were invalid.'
+                )
+                return
+
+    def call_model_fan_out(
+        prompt: str, given_prompt: str, difficulty: str,
+        itr: int, db_name: str
+    ):
+        n_samples = gen_cfg.n_generations_per_database
+        response = client.create(
+            prompt, {'db_id': db_name, 'prompt': given_prompt, 'itr': itr}, n=n_samples
+        )
+        record_usage(db_name, itr, response)
+        output_queue.append({(db_name, 'response', f'{itr}_0'): response})
+        results = parse_choices(response, gen_cfg.query_prefix)
+        if gen_cfg.fan_out_dedupe:
+            results = dedupe_results(results)
+        if dedup_index is not None:
+            results = [result for result in results if dedup_index.add(db_name, result['query'])]
+        if gen_cfg.fan_out_dedupe or dedup_index is not None:
+            logger.debug(f'Kept {len(results)} of {n_samples} samples for {db_name} in iteration {itr}')
+        for i, result in enumerate(results):
+            result['input'] = prompt
+            output_queue.append({(db_name, 'input_output', f'{itr}_{i}'): result})
+            pair = {
                 'db_id': db_name,
                 'question': result['question'],
                 'query': result['query'],
@@ -68,47 +335,83 @@ def generate_sql(api_cfg: APIConfig, gen_cfg: GenerationConfig, db_prompts: Dict
                 'prompt': given_prompt,
                 'difficulty_of_few_shot': difficulty
             }
+            submit_pair(db_name, itr, pair, f'{itr}_{i}')
+        # The whole fan out is one unit so it is finished at the last generation
+        output_queue.append({(db_name, 'journal', f'{itr}'):
+            {'db_name': db_name, 'itr': itr, 'i': n_samples - 1, 'prompt': given_prompt, 'text': prompt}
         })
-        return prompt
 
+    def run_fan_out(db_name: str, itr: int, prompt: Dict[str, str]):
+        # Every sample comes from the same prompt in a single call
+        if (db_name, itr) in finished or stop_event.is_set():
+            return
+        if novelty_collapsed(db_name):
+            logger.warning(f'Skipping db: {db_name} iteration: {itr}. Too few of its recent queries were new.')
+            return
+        diff = prompt["difficulty_of_few_shot"]
+        given_prompt = prompt["prompt"]
+        logger.info(
+            'Sampling {} SQL for db: {} with few shot difficulty: {} and prompt: {}'
+            .format(gen_cfg.n_generations_per_database, db_name, diff, given_prompt)
+        )
+        call_with_retry(call_model_fan_out, prompt["text"], given_prompt, diff, itr, db_name)
+
+    # Chains for different databases and prompts are independent
+    # of each other so they can run at the same time.
+    chains = [
+        (db_name, itr, prompt)
+        for db_name, prompts in db_prompts.items()
+        for itr, prompt in enumerate(prompts)
+    ]
+    if gen_cfg.generation_mode == 'fan_out':
+        run_unit = run_fan_out
+        client.telemetry.set_total_requests(len(chains) - len(finished))
+    elif gen_cfg.generation_mode == 'chain':
+        run_unit = run_chain
+        n_finished = sum(unit['i'] + 1 for unit in finished.values())
+        client.telemetry.set_total_requests(
+            len(chains) * gen_cfg.n_generations_per_database - n_finished
+        )
+    else:
+        raise ValueError(
+            f"Generation mode {gen_cfg.generation_mode} is not valid.",
+            "Generation mode must be one of [chain, fan_out]."
+        )
+
+    def run_scheduled():
+        # Every worker asks the scheduler for its next unit so the
+        # priorities use the pairs of every unit that finished before.
+        while not stop_event.is_set():
+            unit = scheduler.next_unit()
+            if unit is None:
+                return
+            db_name, itr = unit
+            prompts = db_prompts[db_name]
+            try:
+                run_unit(db_name, itr, prompts[itr % len(prompts)])
+            finally:
+                scheduler.finish_unit(db_name, itr)
+
+    if scheduler is not None:
+        client.telemetry.set_total_requests(scheduler.planned_requests())
+        jobs = [()] * max(1, gen_cfg.max_concurrent_chains)
+        run_job = run_scheduled
+    else:
+        jobs = chains
+        run_job = run_unit
+    # Running chains stop at their next call when another chain fails
+    stop_event = threading.Event()
     try:
-        for db_name, prompts in db_prompts.items():
-            for itr, prompt in enumerate(prompts):
-                diff = prompt["difficulty_of_few_shot"]
-                given_prompt = prompt["prompt"]
-                text = prompt["text"]
-                logger.info(
-                    'Generating SQL for db: {} with few shot difficulty: {} and prompt: {}'
-                    .format(db_name, diff, given_prompt)
-                )
-                for i in range(gen_cfg.n_generations_per_database):
-                    logger.debug(f'I am prompt for {db_name} in iteration {itr}\n{text}')
-                    try:
-                        text = call_model(text, given_prompt, diff, itr, i, db_name)
-                    except RateLimitError as e:
-                        if str(e) == "You exceeded your current quota, please check your plan and billing details.":
-                            logger.error('We ran out of tokens :(')
-                            raise e
-                        logger.error('We have hit our rate limit. Writing output then sleeping.')
-                        seconds_spent = output_manager.write_output(output_queue)
-                        logger.debug(f'Spent: {seconds_spent} seconds writing output')
-                        time.sleep(61 - seconds_spent)
-                        text = call_model(text, given_prompt, diff, itr, i, db_name)
-                    except ServiceUnavailableError as e:
-                        logger.error(e)
-                        logger.error('The service was unavailable sleeping for a minute.')
-                        time.sleep(60)
-                        text = call_model(text, given_prompt, diff, itr, i, db_name)
-    except Exception as e:
+        run_concurrently(run_job, jobs, gen_cfg.max_concurrent_chains, stop_event)
+    except (Exception, KeyboardInterrupt) as e:
         # If there's an unexpected exception write output then exit
-        output_manager.write_output(output_queue)
+        close_output()
         raise e
     # Write any remaining output
-    seconds_spent = output_manager.write_output(output_queue)
-    logger.debug(f'Spent: {seconds_spent} seconds writing output')
+    close_output()
+    return output_manager
 
-def parse_response(response: Dict[str, str], sql_prefix: str) -> Dict[str, str]:
-    output = response['choices'][0]['text']
+def parse_output(output: str, sql_prefix: str) -> Dict[str, str]:
     try:
         question, query = output.split(sql_prefix)
     except ValueError:
@@ -121,13 +424,73 @@ def parse_response(response: Dict[str, str], sql_prefix: str) -> Dict[str, str]:
             query = output
     return {'output': output, 'question': question, 'query': query}
 
+def parse_response(response: Dict[str, str], sql_prefix: str) -> Dict[str, str]:
+    return parse_output(response['choices'][0]['text'], sql_prefix)
+
+def parse_choices(response: Dict[str, str], sql_prefix: str) -> List[Dict[str, str]]:
+    return [parse_output(choice['text'], sql_prefix) for choice in response['choices']]
+
+def dedupe_results(results: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    "Keep the first sample of every query that only differs by case, whitespace or quotes."
+    seen = set()
+    unique_results = []
+    for result in results:
+        key = canonicalize_query(result['query'])
+        if key in seen:
+            continue
+        seen.add(key)
+        unique_results.append(result)
+    return unique_results
+
+def dry_run(cfg: ExperimentConfig, db_prompts: Dict[str, List[Dict[str, str]]]) -> Dict:
+    "Plan the units generate_sql would run without calling the API."
+    gen_cfg = cfg.generation_cfg
+    if gen_cfg.target_pairs_per_database > 0:
+        data_output_dir = PARENT_DIR / gen_cfg.data_output_dir
+        counts = count_valid_pairs(data_output_dir, [db for db, prompts in db_prompts.items() if prompts])
+        units = []
+        for db_name, count in sorted(counts.items(), key=lambda item: item[1]):
+            deficit = max(0, gen_cfg.target_pairs_per_database - count)
+            prompts = db_prompts[db_name]
+            n_units = min(
+                math.ceil(deficit / gen_cfg.n_generations_per_database),
+                gen_cfg.max_units_per_database or default_max_units(
+                    gen_cfg.target_pairs_per_database, gen_cfg.n_generations_per_database
+                )
+            )
+            units += [prompts[itr % len(prompts)]['text'] for itr in range(n_units)]
+        if gen_cfg.request_budget:
+            requests_per_unit = 1 if gen_cfg.generation_mode == 'fan_out' else gen_cfg.n_generations_per_database
+            units = units[:gen_cfg.request_budget // requests_per_unit]
+    else:
+        units = [prompt['text'] for prompts in db_prompts.values() for prompt in prompts]
+
+    output_tokens = mean_output_tokens(
+        PATH_TO_FEW_SHOT / gen_cfg.meta_few_shot_file, gen_cfg.query_prefix
+    )
+    plan = plan_gpt_run(cfg.api_cfg, gen_cfg, units, output_tokens)
+    plan = add_time_and_cost(
+        plan, cfg.api_cfg, cfg.dry_run_latency_seconds, gen_cfg.max_concurrent_chains
+    )
+    if gen_cfg.token_budget and plan['total_tokens'] > gen_cfg.token_budget:
+        logger.warning(f'The run would stop at the token budget of {gen_cfg.token_budget} tokens.')
+    log_plan(plan)
+    return plan
+
 @hydra.main(config_path="configs", config_name="gpt", version_base="1.2")
 def main(cfg: ExperimentConfig):
     logger.info(OmegaConf.to_yaml(cfg))
+    raise_on_sigterm()
     
-    prompts = generate_prompts(cfg.generation_cfg)
+    prompts = generate_prompts(
+        cfg.generation_cfg, prompt_token_budget(cfg.api_cfg, cfg.generation_cfg)
+    )
+    if cfg.dry_run:
+        dry_run(cfg, prompts)
+        return
     
-    generate_sql(cfg.api_cfg, cfg.generation_cfg, prompts)
+    resume_dir = PARENT_DIR / cfg.resume if cfg.resume else None
+    generate_sql(cfg.api_cfg, cfg.generation_cfg, prompts, resume_dir)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,99 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from typing import Any, Dict, List, Optional, Union
+from pathlib import Path
+
+logger = logging.getLogger("myLogger")
+
+class CacheMissError(Exception):
+    pass
+
+def make_cache_key(prompt: Union[str, List[str]], completion_kwargs: Dict[str, Any]) -> str:
+    """Hash the prompt and the API config. Numbers are normalized so
+    a temperature of 0 and 0.0 in a yaml file give the same key.
+    """
+    normalized_cfg = {
+        k: float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else v
+        for k, v in completion_kwargs.items()
+    }
+    payload = json.dumps({'prompt': prompt, 'api_cfg': normalized_cfg}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class CompletionCache:
+    """A content addressed store of API responses in a single sqlite
+    file. When the file grows past max_bytes the least recently used
+    responses are evicted.
+
+    The connection is shared by every generation thread so all access
+    goes through a lock.
+    """
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Dict[str, Any]):
+        data = json.dumps(response)
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time())
+            )
+            self._total_bytes += len(data)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM completions ORDER BY last_used"
+        )
+        evicted = []
+        for key, size in rows:
+            if self._total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM completions WHERE key = ?", evicted)
+        logger.debug(f'Evicted {len(evicted)} responses from the completion cache.')
@@ -0,0 +1,243 @@
+import time
+import logging
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from pathlib import Path
+from dataclasses import dataclass
+
+import openai
+
+from omegaconf import OmegaConf
+
+from src.config import APIConfig, CLIENT_ONLY_API_KEYS
+from lib.tokens import estimate_tokens
+from lib.rate_limiter import RateLimiter
+from lib.telemetry import Telemetry
+from lib.completion_cache import CompletionCache, CacheMissError, make_cache_key
+
+PATH_TO_MAIN_DIR = Path(__file__, '../../..').resolve()
+
+CACHE_MODES = ('off', 'read_write', 'replay')
+
+logger = logging.getLogger("myLogger")
+
+@dataclass
+class CompletionClient:
+    """Every call to the completions endpoint goes through this
+    client so the rate limits in the APIConfig are shared by every
+    thread of the generation loop.
+    """
+    completion_kwargs: Dict[str, Any]
+    limiter: RateLimiter
+    cache: Optional[CompletionCache] = None
+    cache_mode: str = "off"
+    cache_sampled_completions: bool = False
+    # Called instead of openai.Completion.create when given.
+    # See lib.mock_completion for an offline backend.
+    backend: Optional[Callable] = None
+    telemetry: Optional[Telemetry] = None
+
+    @classmethod
+    def from_api_cfg(
+        cls, api_cfg: APIConfig, backend: Optional[Callable] = None,
+        output_dir: Optional[Path] = None
+    ) -> 'CompletionClient':
+        """When output_dir is given the telemetry of every call is
+        written to it.
+        """
+        api_cfg = OmegaConf.to_container(api_cfg)
+        limiter = RateLimiter(
+            requests_per_minute=api_cfg['requests_per_minute'],
+            tokens_per_minute=api_cfg['tokens_per_minute']
+        )
+        cache_mode = api_cfg['cache_mode']
+        if cache_mode not in CACHE_MODES:
+            raise ValueError(
+                f"Cache mode {cache_mode} is not valid.",
+                f"cache_mode must be one of {list(CACHE_MODES)}."
+            )
+        cache = None
+        if cache_mode != 'off':
+            cache = CompletionCache(
+                PATH_TO_MAIN_DIR / api_cfg['cache_path'],
+                max_bytes=api_cfg['cache_max_mb'] * 1024 * 1024
+            )
+        client_kwargs = {key: api_cfg.pop(key) for key in CLIENT_ONLY_API_KEYS}
+        telemetry = None
+        if output_dir is not None:
+            telemetry = Telemetry(
+                output_dir,
+                price_per_1k_tokens=client_kwargs['price_per_1k_tokens'],
+                summary_interval_s=client_kwargs['telemetry_interval_seconds']
+            )
+        return cls(
+            completion_kwargs=api_cfg,
+            limiter=limiter,
+            cache=cache,
+            cache_mode=cache_mode,
+            cache_sampled_completions=client_kwargs['cache_sampled_completions'],
+            backend=backend,
+            telemetry=telemetry
+        )
+
+    @property
+    def is_deterministic(self) -> bool:
+        return self.completion_kwargs['temperature'] == 0
+
+    def _kwargs(self, n: Optional[int] = None) -> Dict[str, Any]:
+        """The completion kwargs for a call. n overrides the number of
+        choices of the config, best_of is raised to match if needed.
+        """
+        if n is None:
+            return self.completion_kwargs
+        kwargs = dict(self.completion_kwargs)
+        kwargs['n'] = n
+        kwargs['best_of'] = max(n, kwargs['best_of'])
+        return kwargs
+
+    def estimate_tokens(self, prompt: Union[str, List[str]], n: Optional[int] = None) -> int:
+        """The API reserves max_tokens for every generated choice
+        against the tokens per minute limit, not just what is used.
+        """
+        kwargs = self._kwargs(n)
+        n_prompts = len(prompt) if isinstance(prompt, list) else 1
+        n_choices = max(kwargs['n'], kwargs['best_of'])
+        completion_tokens = kwargs['max_tokens'] * n_choices * n_prompts
+        return estimate_tokens(prompt) + completion_tokens
+
+    def _read_cache(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.cache is None:
+            return None
+        if self.cache_mode == 'read_write' and not (
+            self.is_deterministic or self.cache_sampled_completions
+        ):
+            return None
+        response = self.cache.get(key)
+        if response is None and self.cache_mode == 'replay':
+            raise CacheMissError(f"There was no cached response for the key: {key}")
+        return response
+
+    def _call_api(self, prompt: Union[str, List[str]], n: Optional[int] = None) -> Tuple[Dict[str, Any], float]:
+        """Returns the response and the seconds the API took to answer."""
+        seconds_waited = self.limiter.acquire(self.estimate_tokens(prompt, n))
+        if self.telemetry is not None and seconds_waited:
+            self.telemetry.record_sleep(seconds_waited, 'rate_limiter')
+        backend = self.backend or openai.Completion.create
+        start = time.monotonic()
+        response = backend(
+            prompt=prompt,
+            **self._kwargs(n)
+        )
+        return response, time.monotonic() - start
+
+    def backoff(self, seconds: float, reason: str):
+        "Sleep after the API returned an error."
+        if self.telemetry is not None:
+            self.telemetry.record_error(reason)
+            self.telemetry.record_sleep(seconds, reason)
+        time.sleep(seconds)
+
+    def close(self):
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    def create(
+        self, prompt: str, labels: Optional[Dict[str, Any]] = None, n: Optional[int] = None
+    ) -> Dict[str, Any]:
+        return self.create_batch([prompt], [labels or {}], n)[0]
+
+    def create_batch(
+        self, prompts: List[str], labels: Optional[List[Dict[str, Any]]] = None,
+        n: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Get a response for every prompt. Prompts that are not
+        in the cache are sent to the API in a single request and the
+        response is split so every prompt gets its own response.
+        Each prompt is cached on its own so batched and unbatched
+        runs share the same cache.
+
+        The labels of each prompt, e.g. its db_id, are added to its
+        telemetry record. n overrides the number of choices per prompt.
+        """
+        labels = labels or [{} for _ in prompts]
+        kwargs = self._kwargs(n)
+        keys = [make_cache_key(prompt, kwargs) for prompt in prompts]
+        responses = [self._read_cache(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if len(missing) < len(prompts):
+            logger.debug(f'Using {len(prompts) - len(missing)} cached responses.')
+            if self.telemetry is not None:
+                for _ in range(len(prompts) - len(missing)):
+                    self.telemetry.record_cached()
+        if not missing:
+            return responses
+
+        missing_prompts = [prompts[i] for i in missing]
+        if len(missing_prompts) == 1:
+            response, latency = self._call_api(missing_prompts[0], n)
+            new_responses = [response]
+        else:
+            response, latency = self._call_api(missing_prompts, n)
+            new_responses = split_batch_response(response, missing_prompts, kwargs['n'])
+        for n_recorded, (i, response) in enumerate(zip(missing, new_responses)):
+            responses[i] = response
+            if self.cache is not None:
+                self.cache.put(keys[i], response)
+            if self.telemetry is not None:
+                usage = response.get('usage') or {}
+                self.telemetry.record_call(
+                    latency, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                    labels[i], is_new_request=n_recorded == 0
+                )
+        return responses
+
+def split_batch_response(
+    response: Dict[str, Any], prompts: List[str], n: int
+) -> List[Dict[str, Any]]:
+    """The API returns the n choices of the ith prompt with the
+    indices i*n to i*n + n - 1. Route every choice back to its prompt
+    and renumber it as if the prompt was sent on its own.
+
+    The usage is only reported for the whole batch. It is split
+    between the prompts by the length of their prompt and choices.
+    """
+    choices = [[] for _ in prompts]
+    for choice in sorted(response['choices'], key=lambda c: c['index']):
+        prompt_i, choice_i = divmod(choice['index'], n)
+        choice = dict(choice)
+        choice['index'] = choice_i
+        choices[prompt_i].append(choice)
+
+    usage = response.get('usage')
+    if usage:
+        prompt_tokens = _split_proportionally(
+            usage['prompt_tokens'], [len(p) for p in prompts]
+        )
+        completion_tokens = _split_proportionally(
+            usage['completion_tokens'],
+            [sum(len(c['text']) for c in prompt_choices) for prompt_choices in choices]
+        )
+
+    responses = []
+    for i, prompt_choices in enumerate(choices):
+        new_response = dict(response)
+        new_response['choices'] = prompt_choices
+        new_response['batch_size'] = len(prompts)
+        if usage:
+            new_response['usage'] = {
+                'prompt_tokens': prompt_tokens[i],
+                'completion_tokens': completion_tokens[i],
+                'total_tokens': prompt_tokens[i] + completion_tokens[i]
+            }
+        responses.append(new_response)
+    return responses
+
+def _split_proportionally(total: int, weights: List[int]) -> List[int]:
+    weight_sum = sum(weights)
+    if weight_sum == 0:
+        weights = [1] * len(weights)
+        weight_sum = len(weights)
+    shares = [total * w // weight_sum for w in weights]
+    # Give the rounding remainder to the last share so the sum is exact
+    shares[-1] += total - sum(shares)
+    return shares
@@ -0,0 +1,39 @@
+import logging
+import threading
+
+from typing import Any, Callable, Iterable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+logger = logging.getLogger("myLogger")
+
+def run_concurrently(
+    func: Callable, jobs: Iterable[Tuple[Any, ...]], max_workers: int = 1,
+    stop_event: Optional[threading.Event] = None
+):
+    """Call func(*job) for every job. Jobs run in a thread pool
+    when max_workers > 1, otherwise they run one after another.
+
+    The first exception raised by a job, or a KeyboardInterrupt,
+    cancels every job that has not started yet and is re-raised once
+    the running jobs finish. The stop_event is set at the same time so
+    running jobs that check it can return early.
+    """
+    if max_workers <= 1:
+        for job in jobs:
+            func(*job)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(func, *job) for job in jobs]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                logger.error('A job failed. Cancelling every job that has not started.')
+                raise future.exception()
+    except BaseException:
+        if stop_event is not None:
+            stop_event.set()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -4,7 +4,7 @@ import random
 import logging
 import textwrap
 
-from typing import List, Dict
+from typing import Iterator, List, Dict
 from pathlib import Path
 PARENT_DIR = Path(__file__, '../..').resolve()
 sys.path.append(str(PARENT_DIR))
@@ -16,6 +16,11 @@ import hydra
 from omegaconf import OmegaConf
 
 from src.config import GenerationConfig, ExperimentConfig, CodexGenerationConfig
+from lib.data_files import iter_data_file
+from lib.few_shot_index import FewShotIndex
+from lib.schema_linking import SchemaLinker, get_foreign_keys, get_key_columns
+from lib.prompt_assembler import PromptAssembler
+from lib.tokens import estimate_tokens
 
 PATH_TO_FEW_SHOT = PATH_TO_MAIN_DIR / 'few_shot_prompts'
 
@@ -23,22 +28,31 @@ logger = logging.getLogger("myLogger")
 
 # TODO: Rewrite this to match how we generate for Codex. Make this a List of Dict
 # where the db_name is a key in the dict
-def generate_prompts(cfg: GenerationConfig) -> Dict[str, List[Dict[str, str]]]:
-    if cfg.few_shot_file == "":
-        raise NotImplementedError(
-            "Auto Few shotting is not yet implemented ",
-            "You must provide a human annotated few shot file."
-        )
-
-    path_to_few_shot_file = PATH_TO_MAIN_DIR / cfg.few_shot_file
-    assert path_to_few_shot_file.exists(), f"The few shot file: {path_to_few_shot_file} didn't exist"
-
-    few_shot_db_name = path_to_few_shot_file.parent.name
-    few_shot_prompt = get_few_shot_from_file(path_to_few_shot_file, cfg)
-
+def generate_prompts(cfg: GenerationConfig, token_budget: int = 0) -> Dict[str, List[Dict[str, str]]]:
+    """token_budget limits the tokens of a prompt when the few shot
+    examples are picked automatically. 0 is no limit.
+    """
     with open(PATH_TO_FEW_SHOT / cfg.meta_few_shot_file) as f:
         meta_few_shot = json.load(f)
 
+    index = None
+    few_shot_db_name = None
+    if cfg.few_shot_file == "":
+        # Auto few shotting picks the examples for every database
+        if cfg.n_few_shot_examples <= 0:
+            raise ValueError(
+                f"n_few_shot_examples {cfg.n_few_shot_examples} is not valid.",
+                "n_few_shot_examples must be above 0 when few_shot_file is empty."
+            )
+        index = FewShotIndex(meta_few_shot)
+        assembler = PromptAssembler(token_budget)
+    else:
+        path_to_few_shot_file = PATH_TO_MAIN_DIR / cfg.few_shot_file
+        assert path_to_few_shot_file.exists(), f"The few shot file: {path_to_few_shot_file} didn't exist"
+
+        few_shot_db_name = path_to_few_shot_file.parent.name
+        few_shot_prompt = get_few_shot_from_file(path_to_few_shot_file, cfg)
+
     prompts = {}
     # Here we should iterate through all of the databases
     # But for testing lets just use the architecture db
@@ -49,49 +63,6 @@ def generate_prompts(cfg: GenerationConfig) -> Dict[str, List[Dict[str, str]]]:
         # with open(PATH_TO_FEW_SHOT / db_name / cfg.new_schema_few_shot_name) as f:
             # new_schema = f.read()
 
-    not_complete = [
-        "gymnast",
-        "game_injury",
-        "twitter_1",
-        "book_2",
-        "student_1",
-        "store_1",
-        "scientist_1",
-        "county_public_safety",
-        "ship_mission",
-        "inn_1",
-        "csu_1",
-        "flight_company",
-        "club_1",
-        "theme_gallery",
-        "performance_attendance",
-        "entertainment_awards",
-        "election",
-        "flight_1",
-        "wrestler",
-        "flight_4",
-        "swimming",
-        "candidate_poll",
-        "geo",
-        "game_1",
-        "network_2",
-        "music_4",
-        "perpetrator",
-        "manufactory_1",
-        "musical",
-        "loan_1",
-        "hospital_1",
-        "program_share",
-        "company_office",
-        "cinema",
-        "entrepreneur",
-        "election_representative",
-        "academic",
-        "sports_competition",
-        "match_season",
-        "bike_1"
-    ]
-
     for db in PATH_TO_FEW_SHOT.iterdir():
         if not db.is_dir():
             continue
@@ -101,28 +72,34 @@ def generate_prompts(cfg: GenerationConfig) -> Dict[str, List[Dict[str, str]]]:
         if db_name == few_shot_db_name:
             continue
 
-        if db_name not in not_complete:
+        # An empty list generates for every database
+        if cfg.databases and db_name not in cfg.databases:
             continue
         few_shot_examples = meta_few_shot[db_name]
         with open(db / cfg.new_schema_few_shot_name) as f:
             new_schema = f.read()
+        if index is not None:
+            few_shot_prompt = get_auto_few_shot(
+                db_name, new_schema, few_shot_examples.get("easy", []), index, assembler, cfg
+            )
 
         # TODO: Maybe make this a dict comprehension.
         db_prompts = []
         for prompt in cfg.prompts:
+            # Every fan out sample shares the prompt so ask for variety
+            prompt_lines = [prompt]
+            if cfg.generation_mode == 'fan_out' and cfg.diversity_hint:
+                prompt_lines.append(cfg.diversity_hint)
             for difficulty, examples in few_shot_examples.items():
                 if difficulty != "easy":
                     continue
                 few_shot_example = random.sample(examples, 1)[0]
-                new_few_shot = "{}{}\n{}{}\n".format(
-                    cfg.question_prefix, few_shot_example['question'],
-                    cfg.query_prefix, few_shot_example['query']
-                )
+                new_few_shot = format_example(few_shot_example, cfg)
                 db_prompts.append({
                     'difficulty_of_few_shot': difficulty,
                     'prompt': prompt,
                     'text': '\n'.join(
-                        few_shot_prompt + [new_schema, prompt, new_few_shot, cfg.suffix]
+                        few_shot_prompt + [new_schema] + prompt_lines + [new_few_shot, cfg.suffix]
                     )
                 })
             # Include prompt with no extra few shot
@@ -145,29 +122,127 @@ def get_few_shot_from_file(path_to_few_shot_file: Path, cfg: GenerationConfig) -
     ]
     return few_shot_prompt
 
-def generate_codex_prompts(cfg: CodexGenerationConfig) -> List[Dict[str, str]]:
-    # TODO: Add few shotting to codex prompts
+def format_example(example: Dict[str, str], cfg: GenerationConfig) -> str:
+    return "{}{}\n{}{}\n".format(
+        cfg.question_prefix, example['question'], cfg.query_prefix, example['query']
+    )
+
+def get_auto_few_shot(
+    db_name: str, new_schema: str, extra_examples: List[Dict[str, str]],
+    index: FewShotIndex, assembler: PromptAssembler, cfg: GenerationConfig
+) -> List[str]:
+    """Build the few shot part of the prompt from the database whose
+    questions are most similar to the new schema. Its schema is followed
+    by as many of its n_few_shot_examples questions closest to the new
+    schema as fit in the token budget.
+    """
+    has_schema = {
+        db.name for db in PATH_TO_FEW_SHOT.iterdir()
+        if (db / cfg.new_schema_few_shot_name).exists()
+    }
+    exclude = {db_name} | (set(index.db_ids) - has_schema)
+    few_shot_db_name = index.most_similar_database(new_schema, exclude)
+    with open(PATH_TO_FEW_SHOT / few_shot_db_name / cfg.new_schema_few_shot_name) as f:
+        few_shot_schema = f.read()
+    candidates = index.top_k(new_schema, cfg.n_few_shot_examples, db_id=few_shot_db_name)
+    # Leave room for the longest prompt line and the extra easy example
+    extra_example_tokens = [estimate_tokens(format_example(example, cfg)) for example in extra_examples]
+    fixed_tokens = sum(assembler.count(part) for part in [
+        cfg.header, cfg.table_prefix, few_shot_schema, cfg.table_prefix,
+        new_schema, cfg.diversity_hint, cfg.suffix
+    ]) + max(map(assembler.count, cfg.prompts), default=0) + max(extra_example_tokens, default=0)
+    examples = assembler.pack(fixed_tokens, candidates, lambda example: format_example(example, cfg), 'gpt')
+    logger.debug(f'Using {len(examples)} few shot examples from {few_shot_db_name} for {db_name}')
+    few_shots = '\n'.join([few_shot_schema] + examples)
+    return [cfg.header, cfg.table_prefix, few_shots, cfg.table_prefix]
+
+def generate_codex_prompts(cfg: CodexGenerationConfig, token_budget: int = 0) -> Iterator[Dict[str, str]]:
+    """Stream the prompts of the input data files in order. The input
+    files are read as they are needed and the header and schema of a
+    database are joined once and shared by all of its prompts, so only
+    the prompts being sent are held in memory.
+
+    With schema_pruning the schema is pruned to the tables (and with
+    schema_prune_columns the columns) of every question and the prompt
+    records the schema tokens before and after.
+    Few shot examples are packed into token_budget tokens (0 is no limit).
+    """
     all_few_shot_schemas = read_all_schemas(cfg)
-    prompts = []
+    index = None
+    if cfg.n_few_shot_examples > 0:
+        with open(PATH_TO_FEW_SHOT / cfg.meta_few_shot_file) as f:
+            index = FewShotIndex(json.load(f))
+    assembler = PromptAssembler(token_budget)
+
+    def render_example(example: Dict[str, str]) -> str:
+        example_text = f"{cfg.suffix} {example['question']}\n{example['query']}\n"
+        if cfg.use_commented_few_shot:
+            example_text = textwrap.indent(example_text, "# ", lambda x: True)
+        return example_text
+    schema_prefixes = {}
+    # Schema linkers are built once per database when pruning
+    linkers = {}
+    schema_tokens, pruned_schema_tokens = 0, 0
     for dname, fname in cfg.input_data_files.items():
-        with open(PATH_TO_MAIN_DIR / fname) as f:
-            dataset = json.load(f)
-        for data in dataset:
+        for data in iter_data_file(PATH_TO_MAIN_DIR / fname):
             db_name = data[cfg.db_key]
-            schema = all_few_shot_schemas[db_name]
-            prompt = "\n".join([
-                cfg.header, cfg.table_prefix, schema,
-            ])
+            question = data[cfg.question_key]
+            pruning_stats = {}
+            if cfg.schema_pruning:
+                if db_name not in linkers:
+                    db_path = PATH_TO_MAIN_DIR / cfg.database_dir / db_name / f'{db_name}.sqlite'
+                    linkers[db_name] = SchemaLinker(
+                        all_few_shot_schemas[db_name], get_foreign_keys(db_path), get_key_columns(db_path)
+                    )
+                schema, pruning_stats = linkers[db_name].prune(
+                    question, cfg.schema_max_tables, cfg.schema_max_tokens, cfg.schema_prune_columns
+                )
+                schema_tokens += pruning_stats['schema_tokens']
+                pruned_schema_tokens += pruning_stats['pruned_schema_tokens']
+                schema_prefix = "\n".join([cfg.header, cfg.table_prefix, schema])
+            else:
+                if db_name not in schema_prefixes:
+                    schema_prefixes[db_name] = "\n".join([
+                        cfg.header, cfg.table_prefix, all_few_shot_schemas[db_name],
+                    ])
+                schema_prefix = schema_prefixes[db_name]
+            # The closest questions of the same database are answered
+            # the same way the model should answer the question.
+            few_shots = ""
+            if index is not None:
+                # Paraphrases of the question share its gold query
+                candidates = index.top_k(
+                    question, cfg.n_few_shot_examples, db_id=db_name,
+                    exclude_question=question, exclude_query=data[cfg.query_key]
+                )
+                fixed_tokens = (
+                    assembler.count(schema_prefix, cache=not cfg.schema_pruning)
+                    + assembler.count(f"{cfg.suffix} {question}", cache=False)
+                )
+                few_shots = "".join(assembler.pack(fixed_tokens, candidates, render_example, 'codex'))
             # We want the suffix and question to be on the same line right after the schema
-            prompt += f"{cfg.suffix} {data[cfg.question_key]}"
-            prompts.append({
+            prompt = f"{schema_prefix}{few_shots}{cfg.suffix} {question}"
+            yield {
                 'dataset_name': dname,
                 'db_id': db_name,
-                'question': data[cfg.question_key],
+                'question': question,
                 'gold_sql': data[cfg.query_key],
                 'text': prompt,
-            })
-    return prompts
+                **pruning_stats,
+            }
+    if cfg.schema_pruning and schema_tokens:
+        logger.info(
+            f'Schema pruning kept {pruned_schema_tokens} of {schema_tokens} schema tokens '
+            f'({1 - pruned_schema_tokens / schema_tokens:.1%} saved)'
+        )
+
+def count_codex_prompts(cfg: CodexGenerationConfig) -> int:
+    "The number of prompts generate_codex_prompts yields. Only the input files are read."
+    return sum(
+        1
+        for fname in cfg.input_data_files.values()
+        for _ in iter_data_file(PATH_TO_MAIN_DIR / fname)
+    )
 
 def read_all_schemas(cfg: CodexGenerationConfig) -> Dict[str, str]:
     schemas = {}
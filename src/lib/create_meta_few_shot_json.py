@@ -1,14 +1,24 @@
 import json
+import sqlite3
+import hashlib
+import argparse
 
-from typing import List
+from typing import Dict, List, Tuple
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from evaluation import Evaluator
 from process_sql import get_schema, get_sql, Schema
 
 PATH_TO_SPIDER = Path(__file__, '../../../data/spider').resolve()
 PATH_TO_DATABASE = PATH_TO_SPIDER / 'database'
+OUTPUT_FNAME = 'grouped_questions.json'
+SPIDER_FNAMES = ["train_spider.json", "train_others.json", "dev.json"]
+# What get_sql raises for a query it can not parse. Anything else, like
+# the LookupError of a missing nltk model, stops the build so it is
+# not saved in the manifest as a parse failure.
+PARSE_ERRORS = (AssertionError, IndexError, KeyError, ValueError)
 
 def get_problems(dname: Path, fnames: List[str]):
     probs = []
@@ -24,37 +34,111 @@ def get_problems(dname: Path, fnames: List[str]):
         })
     return db_grouped_probs
 
-def main():
-    all_problems = get_problems(PATH_TO_SPIDER,
-        [
-            "train_spider.json",
-            "train_others.json",
-            "dev.json"
-        ]
-    )
+def fingerprint_database(db_path: Path, question_pairs: List[Dict[str, str]]) -> str:
+    "A hash of the question pairs of a database and of its schema."
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        schema_sql = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY type, name").fetchall()
+    finally:
+        conn.close()
+    content = json.dumps([question_pairs, schema_sql])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-    grouped_results = defaultdict(lambda: defaultdict(list))
+def group_by_hardness(db: str, question_pairs: List[Dict[str, str]]) -> Tuple[Dict[str, List[Dict[str, str]]], List[Dict[str, str]]]:
+    """Group the question pairs of a database by hardness. The schema
+    is read once for all of them. Pairs that can not be parsed are
+    returned as failures with their error instead of being grouped.
+    """
+    db_name = PATH_TO_DATABASE / db / f'{db}.sqlite'
     evaluator = Evaluator()
+    schema = Schema(get_schema(db_name))
+    grouped = defaultdict(list)
+    failures = []
+    for pair in question_pairs:
+        try:
+            sql = get_sql(schema, pair['query'])
+        except PARSE_ERRORS as e:
+            failures.append({**pair, 'error': f'({type(e).__name__}) {e}'})
+            continue
+        hardness = evaluator.eval_hardness(sql)
+        grouped[hardness].append(pair)
+    return grouped, failures
+
+def main(
+    workers: int = 1, rebuild: bool = False,
+    fnames: List[str] = SPIDER_FNAMES, output_fname: str = OUTPUT_FNAME
+):
+    """Leave the split being evaluated out of fnames, and write to a
+    different output_fname, so its questions can not be few shot examples.
+    """
+    all_problems = get_problems(PATH_TO_SPIDER, fnames)
+    manifest_fname = str(Path(output_fname).with_suffix('.manifest.json'))
+
+    # The manifest has the fingerprint and parse failures of every
+    # database in the last build. Only databases with a new fingerprint
+    # are parsed again, the rest are copied from the last build.
+    manifest, previous_results = {}, {}
+    if not rebuild and Path(manifest_fname).exists() and Path(output_fname).exists():
+        with open(manifest_fname) as f:
+            manifest = json.load(f)
+        with open(output_fname) as f:
+            previous_results = json.load(f)
 
+    new_manifest = {}
+    to_parse = []
     for db, question_pairs in all_problems.items():
         # The db would not exist for the databases
         # That we have removed
-        db_name = PATH_TO_DATABASE / db / f'{db}.sqlite'
-        if not db_name.exists():
+        db_path = PATH_TO_DATABASE / db / f'{db}.sqlite'
+        if not db_path.exists():
             continue
-        schema = Schema(get_schema(db_name))
-        for pair in question_pairs:
-            try:
-                sql = get_sql(schema, pair['query'])
-            except Exception as e:
-                print(f'I am the question pair: {pair}')
-                print(f'I am the bd: {db}')
-                raise e
-            hardness = evaluator.eval_hardness(sql)
-            grouped_results[db][hardness].append(pair)
-
-    with open('grouped_questions.json', 'w') as f:
+        fingerprint = fingerprint_database(db_path, question_pairs)
+        old = manifest.get(db)
+        if old is not None and old['fingerprint'] == fingerprint and db in previous_results:
+            new_manifest[db] = old
+        else:
+            new_manifest[db] = {'fingerprint': fingerprint}
+            to_parse.append(db)
+    print(f'Parsing {len(to_parse)} of {len(new_manifest)} databases')
+
+    # Every database is independent so they can be grouped in parallel.
+    # Results are merged in the order of the databases so the output is
+    # the same for any number of workers.
+    pairs_to_parse = [all_problems[db] for db in to_parse]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = dict(zip(to_parse, executor.map(group_by_hardness, to_parse, pairs_to_parse)))
+    else:
+        parsed = dict(zip(to_parse, map(group_by_hardness, to_parse, pairs_to_parse)))
+
+    grouped_results = {}
+    for db in new_manifest:
+        if db in parsed:
+            grouped, failures = parsed[db]
+            new_manifest[db]['failures'] = failures
+            for failure in failures:
+                print(f'Could not parse the query for db: {db} question: {failure["question"]} error: {failure["error"]}')
+            grouped_results[db] = grouped
+        else:
+            grouped_results[db] = previous_results[db]
+
+    with open(output_fname, 'w') as f:
         json.dump(grouped_results, f, indent=4)
+    # The manifest is written last so a failed build is redone next time
+    with open(manifest_fname, 'w') as f:
+        json.dump(new_manifest, f, indent=4)
+    n_failures = sum(len(entry['failures']) for entry in new_manifest.values())
+    print(f'{n_failures} question pairs could not be parsed. See {manifest_fname}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+        help='The number of processes grouping databases at the same time.')
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+        help='Parse every database even if it did not change since the last build.')
+    parser.add_argument('--files', dest='fnames', nargs='+', default=SPIDER_FNAMES,
+        help='The spider files to read questions from. Leave out the split being evaluated.')
+    parser.add_argument('--output', dest='output_fname', default=OUTPUT_FNAME,
+        help='The output file. Its manifest is written next to it.')
+    args = parser.parse_args()
+    main(args.workers, args.rebuild, args.fnames, args.output_fname)
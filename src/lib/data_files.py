@@ -0,0 +1,79 @@
+"""Readers for the generated data files. A run writes its pairs either
+as a json array (<exp_time>.json) or as one json object per line
+(<exp_time>.jsonl). Tools that expect the old json array can use
+read_data_file or convert a jsonl file with:
+
+    python src/lib/data_files.py <file.jsonl> [<output.json>]
+"""
+import sys
+import json
+import logging
+
+from typing import Any, Dict, Iterator, List
+from pathlib import Path
+
+logger = logging.getLogger("myLogger")
+
+def iter_jsonl(fpath: Path) -> Iterator[Dict[str, Any]]:
+    with open(fpath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The writer was killed while writing the last line
+                logger.warning(f'Skipping a partial line in {fpath}: {line}')
+
+def iter_json_array(fpath: Path, chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """Yield the objects of a json array file one at a time without
+    loading the whole file. Only one object is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(fpath) as f:
+        buf = ''
+        started = False
+        while True:
+            chunk = f.read(chunk_size)
+            buf += chunk
+            if not started:
+                buf = buf.lstrip()
+                if not buf and chunk:
+                    continue
+                if not buf.startswith('['):
+                    raise ValueError(f"The file: {fpath} is not a json array.")
+                buf = buf[1:]
+                started = True
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) and buf[pos] == ']':
+                    return
+                try:
+                    obj, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # The rest of the object is in the next chunk
+                    break
+                yield obj
+            buf = buf[pos:]
+            if not chunk:
+                raise ValueError(f"The file: {fpath} ended before the json array was closed.")
+
+def iter_data_file(fpath: Path) -> Iterator[Dict[str, Any]]:
+    if fpath.suffix == '.jsonl':
+        yield from iter_jsonl(fpath)
+    else:
+        yield from iter_json_array(fpath)
+
+def read_data_file(fpath: Path) -> List[Dict[str, Any]]:
+    return list(iter_data_file(fpath))
+
+def convert_jsonl_to_json(input_fpath: Path, output_fpath: Path):
+    with open(output_fpath, 'w') as f:
+        json.dump(read_data_file(input_fpath), f, indent=4)
+
+if __name__ == '__main__':
+    input_fpath = Path(sys.argv[1])
+    output_fpath = Path(sys.argv[2]) if len(sys.argv) > 2 else input_fpath.with_suffix('.json')
+    convert_jsonl_to_json(input_fpath, output_fpath)
@@ -0,0 +1,104 @@
+import json
+import hashlib
+import logging
+import threading
+
+from typing import Any, Dict, Iterable, Optional
+from pathlib import Path
+from collections import defaultdict, deque
+
+from lib.process_sql import Schema, get_schema, get_sql, tokenize
+
+logger = logging.getLogger("myLogger")
+
+def canonicalize_query(query: str, schema: Optional[Schema] = None) -> str:
+    """A canonical form of a query so queries that only differ by
+    case, whitespace, quotes, a trailing semicolon or table aliases
+    are the same. With a schema the query is parsed with get_sql which
+    also resolves aliases and column names. A query that can not be
+    parsed falls back to its token stream and then to its words.
+    """
+    query = query.strip().rstrip(';')
+    if schema is not None:
+        try:
+            return json.dumps(get_sql(schema, query), sort_keys=True)
+        except Exception:
+            pass
+    try:
+        return ' '.join(tokenize(query))
+    except Exception:
+        return ' '.join(query.lower().split())
+
+def query_key(query: str, schema: Optional[Schema] = None) -> str:
+    return hashlib.sha1(canonicalize_query(query, schema).encode('utf-8')).hexdigest()
+
+class DedupIndex:
+    """A set of canonical query hashes per database.
+
+    add returns whether a query is new to its database. The last
+    window results of every database are kept to report how many
+    recent queries were new.
+    """
+    def __init__(self, database_dir: Optional[Path] = None, window: int = 20):
+        self.database_dir = database_dir
+        self.window = window
+        self._lock = threading.Lock()
+        self._keys = defaultdict(set)
+        self._recent = defaultdict(lambda: deque(maxlen=window))
+        self._schemas = {}
+        self.n_seen = defaultdict(int)
+        self.n_new = defaultdict(int)
+
+    def _get_schema(self, db_id: str) -> Optional[Schema]:
+        if db_id not in self._schemas:
+            schema = None
+            if self.database_dir is not None:
+                db_path = self.database_dir / db_id / f'{db_id}.sqlite'
+                if db_path.exists():
+                    schema = Schema(get_schema(str(db_path)))
+                else:
+                    logger.warning(f'No database at: {db_path}. Deduping {db_id} by its tokens.')
+            self._schemas[db_id] = schema
+        return self._schemas[db_id]
+
+    def seed(self, db_id: str, queries: Iterable[str]):
+        "Add queries that were generated before without counting them."
+        keys = {query_key(query, self._get_schema(db_id)) for query in queries}
+        with self._lock:
+            self._keys[db_id] |= keys
+
+    def add(self, db_id: str, query: str) -> bool:
+        key = query_key(query, self._get_schema(db_id))
+        with self._lock:
+            is_new = key not in self._keys[db_id]
+            self._keys[db_id].add(key)
+            self._recent[db_id].append(is_new)
+            self.n_seen[db_id] += 1
+            self.n_new[db_id] += is_new
+        return is_new
+
+    def recent_novelty_rate(self, db_id: str) -> Optional[float]:
+        "The rate of new queries in the last window. None until the window is full."
+        with self._lock:
+            recent = self._recent[db_id]
+            if len(recent) < self.window:
+                return None
+            return sum(recent) / len(recent)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            n_seen = sum(self.n_seen.values())
+            n_new = sum(self.n_new.values())
+            return {
+                'n_seen': n_seen,
+                'n_new': n_new,
+                'novelty_rate': n_new / n_seen if n_seen else None,
+                'per_db': {
+                    db_id: {
+                        'n_seen': self.n_seen[db_id],
+                        'n_new': self.n_new[db_id],
+                        'novelty_rate': self.n_new[db_id] / self.n_seen[db_id]
+                    }
+                    for db_id in self.n_seen
+                }
+            }
@@ -0,0 +1,122 @@
+import json
+import math
+import logging
+
+from typing import Any, Dict, Iterable, List
+from pathlib import Path
+
+from lib.tokens import estimate_tokens
+
+logger = logging.getLogger("myLogger")
+
+def mean_output_tokens(meta_few_shot_path: Path, query_prefix: str, style: str = 'gpt') -> float:
+    """The mean tokens of an answer, taken from the question/query
+    pairs of the meta few shot file. gpt answers with a question and a
+    query, codex only with a query.
+    """
+    with open(meta_few_shot_path) as f:
+        meta_few_shot = json.load(f)
+    lengths = [
+        estimate_tokens(
+            f" {pair['query']}\n" if style == 'codex'
+            else f" {pair['question']}\n{query_prefix}{pair['query']}\n"
+        )
+        for difficulties in meta_few_shot.values()
+        for examples in difficulties.values()
+        for pair in examples
+    ]
+    return sum(lengths) / len(lengths)
+
+def _choices(api_cfg, n: int) -> int:
+    "The API generates and bills best_of choices when it is above n."
+    return max(n, api_cfg.best_of)
+
+def plan_gpt_run(
+    api_cfg, gen_cfg, units: List[str], output_tokens: float
+) -> Dict[str, Any]:
+    """Count the requests and tokens of running every unit (the prompt
+    text of a chain or fan out). In chain mode every call appends its
+    output and the suffix to the prompt so the prompt grows each call.
+    """
+    output_tokens = min(output_tokens, api_cfg.max_tokens)
+    growth = output_tokens + estimate_tokens(f"\n\n{gen_cfg.suffix}")
+    n_generations = gen_cfg.n_generations_per_database
+    plan = {'n_requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'limiter_tokens': 0}
+    for text in units:
+        base_tokens = estimate_tokens(text)
+        if gen_cfg.generation_mode == 'fan_out':
+            calls = [(base_tokens, _choices(api_cfg, n_generations))]
+        else:
+            calls = [(base_tokens + i * growth, _choices(api_cfg, api_cfg.n)) for i in range(n_generations)]
+        for prompt_tokens, n_choices in calls:
+            plan['n_requests'] += 1
+            plan['prompt_tokens'] += prompt_tokens
+            plan['completion_tokens'] += output_tokens * n_choices
+            # The rate limiter reserves max_tokens for every choice
+            plan['limiter_tokens'] += prompt_tokens + api_cfg.max_tokens * n_choices
+    plan['requests_per_unit'] = 1 if gen_cfg.generation_mode == 'fan_out' else n_generations
+    return plan
+
+def plan_codex_run(
+    api_cfg, gen_cfg, prompt_texts: Iterable[str], output_tokens: float
+) -> Dict[str, Any]:
+    "Count the requests and tokens of sending the prompts in batches."
+    output_tokens = min(output_tokens, api_cfg.max_tokens)
+    n_choices = _choices(api_cfg, api_cfg.n)
+    n_prompts, prompt_tokens = 0, 0
+    for text in prompt_texts:
+        n_prompts += 1
+        prompt_tokens += estimate_tokens(text)
+    return {
+        'n_requests': math.ceil(n_prompts / gen_cfg.batch_size),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': output_tokens * n_choices * n_prompts,
+        'limiter_tokens': prompt_tokens + api_cfg.max_tokens * n_choices * n_prompts,
+        'requests_per_unit': 1,
+    }
+
+def add_time_and_cost(
+    plan: Dict[str, Any], api_cfg, latency_s: float, concurrency: int
+) -> Dict[str, Any]:
+    """The wall time is the slowest of making the calls one unit per
+    worker, staying under the requests per minute and staying under
+    the tokens per minute limit.
+    """
+    n_units = plan['n_requests'] / plan['requests_per_unit']
+    bounds = {
+        'latency': math.ceil(n_units / max(1, concurrency)) * plan['requests_per_unit'] * latency_s,
+        'requests_per_minute': 0.0,
+        'tokens_per_minute': 0.0,
+    }
+    if api_cfg.requests_per_minute:
+        bounds['requests_per_minute'] = plan['n_requests'] / api_cfg.requests_per_minute * 60
+    if api_cfg.tokens_per_minute:
+        bounds['tokens_per_minute'] = plan['limiter_tokens'] / api_cfg.tokens_per_minute * 60
+    total_tokens = plan['prompt_tokens'] + plan['completion_tokens']
+    worst_case_tokens = plan['limiter_tokens']
+    plan.update({
+        'total_tokens': total_tokens,
+        'estimated_cost': total_tokens / 1000 * api_cfg.price_per_1k_tokens,
+        'worst_case_cost': worst_case_tokens / 1000 * api_cfg.price_per_1k_tokens,
+        'concurrency': concurrency,
+        'wall_time_s': max(bounds.values()),
+        'limited_by': max(bounds, key=bounds.get),
+    })
+    return plan
+
+def log_plan(plan: Dict[str, Any]):
+    logger.info(
+        'Dry run: {} requests, {:.0f} prompt tokens, {:.0f} completion tokens, '
+        '{:.0f} total tokens'.format(
+            plan['n_requests'], plan['prompt_tokens'],
+            plan['completion_tokens'], plan['total_tokens']
+        )
+    )
+    logger.info(
+        'Dry run: estimated cost ${:.2f} (at most ${:.2f} if every choice uses max_tokens)'
+        .format(plan['estimated_cost'], plan['worst_case_cost'])
+    )
+    logger.info(
+        'Dry run: projected wall time {:.1f} min with {} concurrent units, limited by {}'
+        .format(plan['wall_time_s'] / 60, plan['concurrency'], plan['limited_by'])
+    )
@@ -0,0 +1,106 @@
+import re
+import zlib
+
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+def tokenize_text(text: str) -> List[str]:
+    "Lower case words. Schema names like student_id are split on the underscore."
+    return TOKEN_PATTERN.findall(text.lower())
+
+def normalize_query(query: str) -> str:
+    "Lower case with whitespace collapsed and without the trailing semicolon."
+    return ' '.join(query.lower().split()).rstrip(' ;')
+
+class FewShotIndex:
+    """A TF-IDF index over every question of the meta few shot file.
+
+    Words are hashed into n_features columns so the index is a dense
+    float32 matrix with one L2 normalized row per question. The rows
+    of a database are contiguous so finding the top k questions for a
+    text is a single matrix vector product over a slice.
+    """
+    def __init__(self, meta_few_shot: Dict[str, Dict[str, List[Dict[str, str]]]], n_features: int = 1024):
+        self.n_features = n_features
+        self.examples = []
+        self.db_slices = {}
+        for db_id in sorted(meta_few_shot):
+            start = len(self.examples)
+            for difficulty, pairs in meta_few_shot[db_id].items():
+                for pair in pairs:
+                    self.examples.append({
+                        **pair, 'db_id': db_id, 'difficulty': difficulty,
+                        'example_id': len(self.examples)
+                    })
+            self.db_slices[db_id] = slice(start, len(self.examples))
+        self.difficulties = np.array([example['difficulty'] for example in self.examples])
+        self._questions = np.array([' '.join(tokenize_text(e['question'])) for e in self.examples])
+        self._queries = np.array([normalize_query(e['query']) for e in self.examples])
+
+        counts = np.zeros((len(self.examples), n_features), dtype=np.float32)
+        for row, example in enumerate(self.examples):
+            np.add.at(counts[row], self._hash(tokenize_text(example['question'])), 1)
+        n_docs_with_feature = np.count_nonzero(counts, axis=0)
+        self.idf = (np.log((1 + len(self.examples)) / (1 + n_docs_with_feature)) + 1).astype(np.float32)
+        self.matrix = self._weight(counts)
+        # The mean question of every database, used to compare databases
+        self.db_ids = list(self.db_slices)
+        self.db_matrix = self._normalize(np.stack([
+            self.matrix[self.db_slices[db_id]].sum(axis=0) for db_id in self.db_ids
+        ]))
+
+    def _hash(self, tokens: Iterable[str]) -> np.ndarray:
+        # crc32 is stable between runs unlike hash()
+        return np.array([zlib.crc32(t.encode('utf-8')) % self.n_features for t in tokens], dtype=np.int64)
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _weight(self, counts: np.ndarray) -> np.ndarray:
+        tf = np.where(counts > 0, 1 + np.log(np.maximum(counts, 1)), 0)
+        return self._normalize(tf * self.idf).astype(np.float32)
+
+    def vectorize(self, text: str) -> np.ndarray:
+        counts = np.zeros(self.n_features, dtype=np.float32)
+        np.add.at(counts, self._hash(tokenize_text(text)), 1)
+        return self._weight(counts)
+
+    def top_k(
+        self, text: str, k: int, db_id: Optional[str] = None,
+        difficulty: Optional[str] = None, exclude_question: Optional[str] = None,
+        exclude_query: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """The k questions most similar to the text, best first. The
+        search can be limited to a database and a difficulty. A question
+        equal to exclude_question, or a question whose query is equal to
+        exclude_query, is never returned. Paraphrases of a question share
+        its query so both are needed to keep the answer out of a prompt.
+        """
+        rows = self.db_slices.get(db_id, slice(0, 0)) if db_id is not None else slice(0, len(self.examples))
+        scores = self.matrix[rows] @ self.vectorize(text)
+        if difficulty is not None:
+            scores = np.where(self.difficulties[rows] == difficulty, scores, -np.inf)
+        if exclude_question is not None:
+            excluded = self._questions[rows] == ' '.join(tokenize_text(exclude_question))
+            scores = np.where(excluded, -np.inf, scores)
+        if exclude_query is not None:
+            excluded = self._queries[rows] == normalize_query(exclude_query)
+            scores = np.where(excluded, -np.inf, scores)
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [self.examples[rows.start + i] for i in best]
+
+    def most_similar_database(self, text: str, exclude: Iterable[str] = ()) -> str:
+        scores = self.db_matrix @ self.vectorize(text)
+        for i in np.argsort(-scores, kind='stable'):
+            if self.db_ids[i] not in exclude:
+                return self.db_ids[i]
+        raise ValueError("Every database was excluded.")
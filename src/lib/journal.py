@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+import threading
+
+from typing import Any, Dict, List
+from pathlib import Path
+
+logger = logging.getLogger("myLogger")
+
+JOURNAL_FNAME = "journal.jsonl"
+
+class GenerationJournal:
+    """An append only log of the work units that have been written
+    to disk. Every line is one json object describing a finished unit.
+    The file is flushed on every record and fsynced every fsync_every
+    records, or when sync is called.
+
+    OutputManager records a unit only after the output queued before
+    it has been written, so a unit in the journal is never missing
+    its output.
+    """
+    def __init__(self, run_dir: Path, fsync_every: int = 20):
+        self.path = run_dir / JOURNAL_FNAME
+        self.fsync_every = fsync_every
+        self._n_unsynced = 0
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a')
+
+    def record(self, unit: Dict[str, Any]):
+        with self._lock:
+            self._file.write(json.dumps(unit) + '\n')
+            self._file.flush()
+            self._n_unsynced += 1
+            if self._n_unsynced >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+
+    def sync(self):
+        with self._lock:
+            if self._n_unsynced:
+                self._sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def resume_from(self, run_dir: Path) -> List[Dict[str, Any]]:
+        """Read the units finished by a previous run and copy them into
+        this journal so the current run can be resumed as well.
+        """
+        units = read_journal(run_dir)
+        logger.info(f'Resuming {len(units)} finished units from {run_dir}')
+        for unit in units:
+            self.record(unit)
+        self.sync()
+        return units
+
+def read_journal(run_dir: Path) -> List[Dict[str, Any]]:
+    path = run_dir / JOURNAL_FNAME
+    assert path.exists(), f"The journal: {path} didn't exist"
+    units = []
+    with open(path) as f:
+        for line in f:
+            try:
+                units.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The run was killed while writing the last line
+                logger.warning(f'Skipping a partial line in the journal: {line}')
+    return units
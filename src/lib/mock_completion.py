@@ -0,0 +1,107 @@
+import json
+import math
+import time
+import random
+import threading
+
+from typing import Any, Dict, List, Union
+from pathlib import Path
+
+from openai.error import RateLimitError, ServiceUnavailableError
+
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'lognormal')
+
+class MockCompletion:
+    """A local stand in for openai.Completion.create. It sleeps for a
+    random latency, raises the API errors at the configured rates and
+    answers with question/query pairs from the meta few shot file.
+
+    The gpt style answers like text-davinci-003 does in gen_sql
+    (<question>\\n<query_prefix><query>). The codex style only answers
+    with a query like code-davinci-002 does in run_codex.
+
+    Pass the create method as the backend of a CompletionClient.
+    """
+    def __init__(
+        self, meta_few_shot_path: Path, style: str = 'gpt',
+        query_prefix: str = 'SQL: ', latency_distribution: str = 'lognormal',
+        latency_mean_s: float = 1.0, latency_sigma: float = 0.5,
+        rate_limit_error_rate: float = 0.0, service_unavailable_rate: float = 0.0,
+        random_seed: int = 42
+    ):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Latency distribution {latency_distribution} is not valid.",
+                f"Latency distribution must be one of {list(LATENCY_DISTRIBUTIONS)}."
+            )
+        with open(meta_few_shot_path) as f:
+            meta_few_shot = json.load(f)
+        self.pairs = [
+            pair
+            for difficulties in meta_few_shot.values()
+            for examples in difficulties.values()
+            for pair in examples
+        ]
+        self.style = style
+        self.query_prefix = query_prefix
+        self.latency_distribution = latency_distribution
+        self.latency_mean_s = latency_mean_s
+        self.latency_sigma = latency_sigma
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.service_unavailable_rate = service_unavailable_rate
+        self._random = random.Random(random_seed)
+        # Generation threads share the mock
+        self._lock = threading.Lock()
+        self.n_calls = 0
+        self.n_errors = 0
+
+    def _sample_latency(self) -> float:
+        if self.latency_distribution == 'constant':
+            return self.latency_mean_s
+        if self.latency_distribution == 'uniform':
+            return self._random.uniform(0, 2 * self.latency_mean_s)
+        # Pick mu so the mean of the lognormal is latency_mean_s
+        mu = math.log(self.latency_mean_s) - self.latency_sigma ** 2 / 2
+        return self._random.lognormvariate(mu, self.latency_sigma)
+
+    def _sample_text(self) -> str:
+        pair = self._random.choice(self.pairs)
+        if self.style == 'codex':
+            return f" {pair['query']}\n"
+        return f" {pair['question']}\n{self.query_prefix}{pair['query']}\n"
+
+    def create(self, prompt: Union[str, List[str]], model: str, n: int = 1, **kwargs) -> Dict[str, Any]:
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        with self._lock:
+            self.n_calls += 1
+            latency = self._sample_latency()
+            error_draw = self._random.random()
+            texts = [self._sample_text() for _ in range(len(prompts) * n)]
+        time.sleep(latency)
+
+        if error_draw < self.rate_limit_error_rate:
+            with self._lock:
+                self.n_errors += 1
+            raise RateLimitError("Rate limit reached for the mock backend.")
+        if error_draw < self.rate_limit_error_rate + self.service_unavailable_rate:
+            with self._lock:
+                self.n_errors += 1
+            raise ServiceUnavailableError("The mock server is overloaded.")
+
+        prompt_tokens = sum(len(p) // 4 for p in prompts)
+        completion_tokens = sum(len(t) // 4 for t in texts)
+        return {
+            'id': f'mock-{self.n_calls}',
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [
+                {'text': text, 'index': i, 'logprobs': None, 'finish_reason': 'stop'}
+                for i, text in enumerate(texts)
+            ],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        }
@@ -0,0 +1,74 @@
+import logging
+
+from typing import Any, Callable, Dict, Hashable, List
+
+from lib.tokens import estimate_tokens
+
+logger = logging.getLogger("myLogger")
+
+def usable_context_window(api_cfg) -> int:
+    """The context window less the margin for estimate_tokens counting
+    too few tokens. Compare it to estimated tokens, not the real window.
+    """
+    return int(api_cfg.context_window * (1 - api_cfg.context_window_margin))
+
+def prompt_token_budget(api_cfg, gen_cfg) -> int:
+    """The estimated tokens a prompt may use so the prompt and max_tokens
+    fit in the context window of the model. prompt_token_budget lowers
+    it, for example to leave room for a gen_sql chain to grow.
+    """
+    budget = usable_context_window(api_cfg) - api_cfg.max_tokens
+    if gen_cfg.prompt_token_budget:
+        budget = min(budget, gen_cfg.prompt_token_budget)
+    return budget
+
+class PromptAssembler:
+    """Packs ranked few shot examples into a prompt without going over
+    the token budget (0 is no limit).
+
+    The rendered text and token count of every example, and the token
+    count of reused parts like schemas, are cached so assembling a
+    prompt only costs a lookup per candidate example.
+    """
+    def __init__(self, token_budget: int = 0):
+        self.token_budget = token_budget
+        self._token_counts = {}
+        self._examples = {}
+
+    def count(self, text: str, cache: bool = True) -> int:
+        "Pass cache=False for text that is only used once, like a question."
+        if not cache:
+            return estimate_tokens(text)
+        if text not in self._token_counts:
+            self._token_counts[text] = estimate_tokens(text)
+        return self._token_counts[text]
+
+    def _render(self, key: Hashable, example: Dict[str, Any], render: Callable[[Dict[str, Any]], str]):
+        if key not in self._examples:
+            text = render(example)
+            self._examples[key] = (text, estimate_tokens(text))
+        return self._examples[key]
+
+    def pack(
+        self, fixed_tokens: int, examples: List[Dict[str, Any]],
+        render: Callable[[Dict[str, Any]], str], style: Hashable = None
+    ) -> List[str]:
+        """The rendered examples that fit next to fixed_tokens tokens, in
+        rank order. An example that does not fit is skipped so a shorter
+        one after it can still be used. Examples are cached by style and
+        their example_id so every style of rendering has its own cache.
+        """
+        remaining = self.token_budget - fixed_tokens
+        if self.token_budget and remaining < 0:
+            logger.warning(
+                f'The prompt is {fixed_tokens} tokens without few shot examples. '
+                f'That is over the budget of {self.token_budget} tokens.'
+            )
+        texts = []
+        for example in examples:
+            text, n_tokens = self._render((style, example['example_id']), example, render)
+            if self.token_budget and n_tokens > remaining:
+                continue
+            texts.append(text)
+            remaining -= n_tokens
+        return texts
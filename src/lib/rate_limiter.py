@@ -0,0 +1,73 @@
+import time
+import logging
+import threading
+
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("myLogger")
+
+@dataclass
+class TokenBucket:
+    """A bucket that holds at most `per_minute` units and refills
+    continuously at `per_minute` units per minute. Taking more than
+    is in the bucket puts it in debt. The caller must then wait the
+    number of seconds returned before it can spend what it took.
+    """
+    per_minute: float
+    _level: float = field(init=False)
+    _last_refill: float = field(init=False)
+
+    def __post_init__(self):
+        self._level = self.per_minute
+        self._last_refill = time.monotonic()
+
+    def take(self, amount: float) -> float:
+        now = time.monotonic()
+        rate = self.per_minute / 60
+        self._level = min(self.per_minute, self._level + (now - self._last_refill) * rate)
+        self._last_refill = now
+        self._level -= amount
+        if self._level >= 0:
+            return 0.0
+        return -self._level / rate
+
+@dataclass
+class RateLimiter:
+    """Paces API calls so they stay under a requests per minute
+    and a tokens per minute budget instead of waiting for a
+    RateLimitError. A budget of 0 is not limited.
+
+    The limiter is thread safe. Concurrent callers reserve their
+    share under a lock then sleep outside of it, so calls are
+    released in the order they arrived.
+    """
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+    _buckets: dict = field(init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        self._buckets = {}
+        if self.requests_per_minute > 0:
+            self._buckets['requests'] = TokenBucket(self.requests_per_minute)
+        if self.tokens_per_minute > 0:
+            self._buckets['tokens'] = TokenBucket(self.tokens_per_minute)
+
+    def acquire(self, n_tokens: int, n_requests: int = 1) -> float:
+        """Block until a call of n_tokens can be made.
+
+        Returns:
+            float: Number of seconds spent waiting.
+        """
+        if not self._buckets:
+            return 0.0
+        amounts = {'requests': n_requests, 'tokens': n_tokens}
+        with self._lock:
+            wait = max(
+                bucket.take(amounts[name])
+                for name, bucket in self._buckets.items()
+            )
+        if wait > 0:
+            logger.debug(f'Rate limiter is waiting {wait:.2f} seconds for {n_tokens} tokens.')
+            time.sleep(wait)
+        return wait
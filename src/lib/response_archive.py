@@ -0,0 +1,134 @@
+import gzip
+import json
+import logging
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("myLogger")
+
+ARCHIVE_FNAMES = {
+    'gzip': 'responses.jsonl.gz',
+    'zstd': 'responses.jsonl.zst',
+}
+INDEX_FNAME = 'responses.idx.jsonl'
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+class ResponseArchiveWriter:
+    """Appends every response and input_output record of a database to
+    one compressed file. Each record is compressed as its own frame
+    so it can be read back on its own. The byte range of every frame
+    is written to an index file next to the archive.
+
+    A gzip archive is a valid .jsonl.gz file so zcat works on it too.
+    """
+    def __init__(self, db_dir: Path, compression: str = 'gzip'):
+        if compression not in ARCHIVE_FNAMES:
+            raise ValueError(
+                f"Compression {compression} is not valid.",
+                f"Compression must be one of {list(ARCHIVE_FNAMES)}."
+            )
+        if compression == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed. Falling back to gzip.')
+            compression = 'gzip'
+        self.compression = compression
+        self._archive = open(db_dir / ARCHIVE_FNAMES[compression], 'ab')
+        self._index = open(db_dir / INDEX_FNAME, 'a')
+        self._offset = self._archive.tell()
+
+    def append(self, output_type: str, itr: str, data: Dict[str, Any]):
+        record = json.dumps({'output_type': output_type, 'itr': itr, 'data': data}) + '\n'
+        frame = _compress(record.encode('utf-8'), self.compression)
+        self._archive.write(frame)
+        self._index.write(json.dumps({
+            'output_type': output_type, 'itr': itr,
+            'offset': self._offset, 'length': len(frame),
+            'compression': self.compression
+        }) + '\n')
+        self._offset += len(frame)
+
+    def flush(self):
+        # The archive is flushed first so the index never
+        # points past the end of the archive.
+        self._archive.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._archive.close()
+        self._index.close()
+
+class ResponseArchiveReader:
+    """Reads the archives written under an experiment's
+    gpt_input_output dir. Records can be iterated in the order they
+    were written or fetched one at a time with the offset index.
+    """
+    def __init__(self, archive_dir: Path):
+        self.archive_dir = archive_dir
+        self._indexes = {}
+
+    def databases(self) -> List[str]:
+        return sorted(
+            dpath.name for dpath in self.archive_dir.iterdir()
+            if (dpath / INDEX_FNAME).exists()
+        )
+
+    def _index(self, db_name: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        if db_name not in self._indexes:
+            index = {}
+            with open(self.archive_dir / db_name / INDEX_FNAME) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The writer was killed while writing the index
+                        continue
+                    index[(entry['output_type'], str(entry['itr']))] = entry
+            self._indexes[db_name] = index
+        return self._indexes[db_name]
+
+    def _read_frame(self, f, entry: Dict[str, Any]) -> Dict[str, Any]:
+        f.seek(entry['offset'])
+        frame = f.read(entry['length'])
+        return json.loads(_decompress(frame, entry['compression']))
+
+    def get(self, db_name: str, itr: Any, output_type: str = 'response') -> Optional[Dict[str, Any]]:
+        """Fetch one record without decompressing the rest of the archive."""
+        entry = self._index(db_name).get((output_type, str(itr)))
+        if entry is None:
+            return None
+        with open(self.archive_dir / db_name / ARCHIVE_FNAMES[entry['compression']], 'rb') as f:
+            return self._read_frame(f, entry)['data']
+
+    def iter_records(self, db_name: str, output_type: Optional[str] = None) -> Iterator[Tuple[str, str, Dict[str, Any]]]:
+        """Yield (output_type, itr, data) for every record of the database."""
+        entries = sorted(self._index(db_name).values(), key=lambda e: e['offset'])
+        files = {}
+        try:
+            for entry in entries:
+                if output_type is not None and entry['output_type'] != output_type:
+                    continue
+                compression = entry['compression']
+                if compression not in files:
+                    files[compression] = open(
+                        self.archive_dir / db_name / ARCHIVE_FNAMES[compression], 'rb'
+                    )
+                record = self._read_frame(files[compression], entry)
+                yield record['output_type'], record['itr'], record['data']
+        finally:
+            for f in files.values():
+                f.close()
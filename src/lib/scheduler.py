@@ -0,0 +1,166 @@
+import json
+import math
+import logging
+import threading
+
+from typing import Dict, Iterable, Optional, Tuple
+from pathlib import Path
+from collections import defaultdict
+
+from lib.data_files import iter_data_file
+
+logger = logging.getLogger("myLogger")
+
+VALID_PAIRS_FNAME = 'syntax_correct_data.json'
+
+def count_valid_pairs(data_output_dir: Path, db_names: Iterable[str]) -> Dict[str, int]:
+    """Count the pairs of the run files of every database that are known
+    to be valid. The is_valid of inline validation wins. A pair without
+    it counts only when validate_sql.py wrote it to syntax_correct_data.json.
+    Pairs that were never validated are not counted.
+    """
+    counts = {}
+    for db_name in db_names:
+        db_dir = data_output_dir / db_name
+        valid_keys = set()
+        if (db_dir / VALID_PAIRS_FNAME).exists():
+            with open(db_dir / VALID_PAIRS_FNAME) as f:
+                valid_keys = {(pair['question'], pair['query']) for pair in json.load(f)}
+        counts[db_name] = sum(
+            1
+            for fpath in sorted(db_dir.glob('[0-9]*.json*'))
+            for pair in iter_data_file(fpath)
+            if pair.get('is_valid', (pair['question'], pair['query']) in valid_keys)
+        )
+    return counts
+
+def default_max_units(target: int, pairs_per_unit: int) -> int:
+    "Twice the units needed to reach the target from no pairs."
+    return 2 * math.ceil(target / pairs_per_unit)
+
+class GenerationScheduler:
+    """Hands out generation units to the databases furthest below the
+    target number of valid pairs.
+
+    A unit is one chain or fan out of a database and is expected to
+    add pairs_per_unit pairs and to make requests_per_unit requests.
+    The counts are updated as pairs come in so the next unit always
+    goes to the database with the largest deficit that is not already
+    covered by running units. No unit is handed out once the request
+    or token budget (0 is unlimited) could be exceeded by it.
+
+    A database whose pairs keep coming back invalid or duplicated would
+    keep the largest deficit forever, so it is retired after
+    max_units_per_database units. 0 is twice the units the target needs.
+    """
+    def __init__(
+        self, counts: Dict[str, int], target: int, pairs_per_unit: int,
+        requests_per_unit: int, request_budget: int = 0, token_budget: int = 0,
+        max_units_per_database: int = 0
+    ):
+        self.counts = dict(counts)
+        self.target = target
+        self.pairs_per_unit = pairs_per_unit
+        self.requests_per_unit = requests_per_unit
+        self.request_budget = request_budget
+        self.token_budget = token_budget
+        self.max_units_per_database = max_units_per_database or default_max_units(target, pairs_per_unit)
+        self._lock = threading.Lock()
+        self._n_assigned = defaultdict(int)
+        # The [requests, pairs] of every running unit
+        self._running = {}
+        self._excluded = set()
+        self.requests_used = 0
+        self.tokens_used = 0
+
+    def _deficit(self, db_name: str) -> int:
+        expected = self.counts[db_name] + sum(
+            max(0, self.pairs_per_unit - n_pairs)
+            for (unit_db_name, _), (_, n_pairs) in self._running.items()
+            if unit_db_name == db_name
+        )
+        return self.target - expected
+
+    def _units_left(self, db_name: str) -> int:
+        return max(0, self.max_units_per_database - self._n_assigned[db_name])
+
+    def _reserved_requests(self) -> int:
+        return sum(
+            max(0, self.requests_per_unit - n_requests)
+            for n_requests, _ in self._running.values()
+        )
+
+    def _within_budget(self) -> bool:
+        n_requests = self.requests_used + self._reserved_requests() + self.requests_per_unit
+        if self.request_budget and n_requests > self.request_budget:
+            return False
+        if self.token_budget and self.requests_used:
+            tokens_per_request = self.tokens_used / self.requests_used
+            if self.tokens_used + tokens_per_request * (n_requests - self.requests_used) > self.token_budget:
+                return False
+        return True
+
+    def planned_requests(self) -> int:
+        "The number of requests needed to reach the target for every database."
+        with self._lock:
+            n_units = sum(
+                min(
+                    math.ceil(max(0, self._deficit(db_name)) / self.pairs_per_unit),
+                    self._units_left(db_name)
+                )
+                for db_name in self.counts if db_name not in self._excluded
+            )
+            n_requests = n_units * self.requests_per_unit
+            if self.request_budget:
+                n_requests = min(n_requests, self.request_budget - self.requests_used)
+            return n_requests
+
+    def next_unit(self) -> Optional[Tuple[str, int]]:
+        """The database and iteration of the next unit to run. None once
+        every database reached the target or was retired or the budget is spent.
+        """
+        with self._lock:
+            if not self._within_budget():
+                logger.info('The generation budget is spent. No more units will be started.')
+                return None
+            for db_name in self.counts:
+                if db_name not in self._excluded and self._deficit(db_name) > 0 and not self._units_left(db_name):
+                    logger.warning(
+                        f'Retiring db: {db_name} after {self.max_units_per_database} units. '
+                        f'It has {self.counts[db_name]} of {self.target} valid pairs.'
+                    )
+                    self._excluded.add(db_name)
+            candidates = [
+                db_name for db_name in self.counts
+                if db_name not in self._excluded and self._deficit(db_name) > 0
+            ]
+            if not candidates:
+                return None
+            db_name = max(candidates, key=self._deficit)
+            itr = self._n_assigned[db_name]
+            self._n_assigned[db_name] += 1
+            self._running[(db_name, itr)] = [0, 0]
+            logger.debug(f'Scheduling db: {db_name} iteration: {itr} with deficit: {self._deficit(db_name)}')
+            return db_name, itr
+
+    def finish_unit(self, db_name: str, itr: int):
+        with self._lock:
+            self._running.pop((db_name, itr))
+
+    def record_request(self, db_name: str, itr: int, n_tokens: int):
+        with self._lock:
+            self.requests_used += 1
+            self.tokens_used += n_tokens
+            if (db_name, itr) in self._running:
+                self._running[(db_name, itr)][0] += 1
+
+    def record_pair(self, db_name: str, itr: int, is_valid: bool = True):
+        with self._lock:
+            if (db_name, itr) in self._running:
+                self._running[(db_name, itr)][1] += 1
+            self.counts[db_name] += is_valid
+
+    def exclude(self, db_name: str):
+        "Stop scheduling a database, for example once it stops producing new queries."
+        with self._lock:
+            self._excluded.add(db_name)
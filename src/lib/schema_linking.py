@@ -0,0 +1,182 @@
+import re
+import sqlite3
+import logging
+
+from typing import Dict, List, Optional, Set, Tuple
+from pathlib import Path
+
+from lib.tokens import estimate_tokens
+
+logger = logging.getLogger("myLogger")
+
+# A table line of a schema file looks like: table_name(col_1, col_2)
+# It can start with the # of a commented schema.
+TABLE_LINE = re.compile(r'^\s*(?:#\s*)?(\w+)\s*\((.*)\)\s*$')
+WORD = re.compile(r'[a-z0-9]+')
+IDENTIFIER = re.compile(r'[a-z0-9_]+')
+
+def _words(text: str) -> Set[str]:
+    "Lower case words without a plural s. student_ids becomes student and id."
+    return {word[:-1] if len(word) > 3 and word.endswith('s') else word for word in WORD.findall(text.lower())}
+
+def get_foreign_keys(db_path: Path) -> Set[Tuple[str, str]]:
+    "Pairs of tables joined by a foreign key. Empty when there is no database."
+    if not db_path.exists():
+        return set()
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        foreign_keys = set()
+        for table in tables:
+            for row in conn.execute(f'PRAGMA foreign_key_list("{table}")'):
+                foreign_keys.add((table.lower(), row[2].lower()))
+                foreign_keys.add((row[2].lower(), table.lower()))
+        return foreign_keys
+    finally:
+        conn.close()
+
+def get_key_columns(db_path: Path) -> Dict[str, Set[str]]:
+    "The primary and foreign key columns of every table. Empty when there is no database."
+    if not db_path.exists():
+        return {}
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        key_columns = {table.lower(): set() for table in tables}
+        for table in tables:
+            for row in conn.execute(f'PRAGMA table_info("{table}")'):
+                if row[5]:
+                    key_columns[table.lower()].add(row[1].lower())
+            for row in conn.execute(f'PRAGMA foreign_key_list("{table}")'):
+                key_columns[table.lower()].add(row[3].lower())
+                if row[4] is not None:
+                    key_columns.setdefault(row[2].lower(), set()).add(row[4].lower())
+        return key_columns
+    finally:
+        conn.close()
+
+def _split_columns(columns: str) -> List[Tuple[str, str]]:
+    "The text and lower case name, e.g. singer_id, of every column of a table line."
+    split = []
+    for text in columns.split(','):
+        text = text.strip()
+        name = IDENTIFIER.search(text.lower())
+        if name is not None:
+            split.append((text, name.group(0)))
+    return split
+
+class SchemaLinker:
+    """Keeps the tables, and optionally the columns, of a schema that a
+    question is about.
+
+    The words of every table name and of its columns are indexed once
+    per database. A table scores 2 for every question word in its name
+    and 1 for every question word in its columns. The best tables are
+    kept in order of their score until the table or token budget is
+    reached (0 is no limit). A table joined by foreign keys to two kept
+    tables is kept as well so the join path is not lost. Lines that are
+    not tables are always kept. A question that matches no table keeps
+    the whole schema.
+
+    With prune_columns a kept table only keeps the columns with a
+    question word and its primary and foreign key columns, so joins
+    can still be written. A table with none of those keeps every column.
+    """
+    def __init__(
+        self, schema: str, foreign_keys: Set[Tuple[str, str]] = frozenset(),
+        key_columns: Optional[Dict[str, Set[str]]] = None
+    ):
+        key_columns = key_columns or {}
+        self.schema = schema
+        self.lines = schema.splitlines(keepends=True)
+        self.full_tokens = estimate_tokens(schema)
+        self.tables = {}
+        for line_idx, line in enumerate(self.lines):
+            match = TABLE_LINE.match(line)
+            if match is None:
+                continue
+            name = match.group(1).lower()
+            self.tables[name] = {
+                'line_idx': line_idx,
+                'name_words': _words(name),
+                'column_words': _words(match.group(2)),
+                'tokens': estimate_tokens(line),
+                # Everything around the columns, e.g. "# singer(" and ")\n"
+                'before_columns': line[:match.start(2)],
+                'after_columns': line[match.end(2):],
+                'columns': [
+                    (text, _words(column_name), column_name in key_columns.get(name, ()))
+                    for text, column_name in _split_columns(match.group(2))
+                ],
+            }
+        self.neighbors = {name: set() for name in self.tables}
+        for table, other in foreign_keys:
+            if table in self.tables and other in self.tables:
+                self.neighbors[table].add(other)
+
+    def score(self, question: str) -> Dict[str, int]:
+        words = _words(question)
+        return {
+            name: 2 * len(words & table['name_words']) + len(words & table['column_words'])
+            for name, table in self.tables.items()
+        }
+
+    def _prune_columns(self, name: str, words: Set[str]) -> str:
+        "The table line with only the columns with a question word and the key columns."
+        table = self.tables[name]
+        columns = [text for text, column_words, is_key in table['columns'] if is_key or words & column_words]
+        if not columns:
+            return self.lines[table['line_idx']]
+        return table['before_columns'] + ', '.join(columns) + table['after_columns']
+
+    def prune(
+        self, question: str, max_tables: int = 0, max_tokens: int = 0,
+        prune_columns: bool = False
+    ) -> Tuple[str, Dict[str, int]]:
+        "Returns the pruned schema and its token counts before and after pruning."
+        scores = self.score(question)
+        ranked = [name for name in sorted(scores, key=lambda n: (-scores[n], self.tables[n]['line_idx'])) if scores[name] > 0]
+        if not ranked:
+            return self.schema, {'schema_tokens': self.full_tokens, 'pruned_schema_tokens': self.full_tokens}
+
+        words = _words(question)
+        lines = {}
+        for name, table in self.tables.items():
+            lines[table['line_idx']] = self._prune_columns(name, words) if prune_columns else None
+
+        def table_tokens(name: str) -> int:
+            line = lines[self.tables[name]['line_idx']]
+            return self.tables[name]['tokens'] if line is None else estimate_tokens(line)
+
+        other_tokens = self.full_tokens - sum(table['tokens'] for table in self.tables.values())
+        kept = []
+        n_tokens = other_tokens
+
+        def fits(name: str) -> bool:
+            if max_tables and len(kept) >= max_tables:
+                return False
+            return not max_tokens or n_tokens + table_tokens(name) <= max_tokens
+
+        for name in ranked:
+            # Always keep the best table even if it is over the budget
+            if kept and not fits(name):
+                break
+            kept.append(name)
+            n_tokens += table_tokens(name)
+        bridges = [
+            name for name in self.tables
+            if name not in kept and len(self.neighbors[name] & set(kept)) >= 2
+        ]
+        for name in bridges:
+            if fits(name):
+                kept.append(name)
+                n_tokens += table_tokens(name)
+
+        dropped_lines = {
+            table['line_idx'] for name, table in self.tables.items() if name not in kept
+        }
+        pruned = ''.join(
+            line if lines.get(i) is None else lines[i]
+            for i, line in enumerate(self.lines) if i not in dropped_lines
+        )
+        return pruned, {'schema_tokens': self.full_tokens, 'pruned_schema_tokens': estimate_tokens(pruned)}
@@ -0,0 +1,68 @@
+import time
+import sqlite3
+
+from typing import Any
+from contextlib import contextmanager
+
+# How many sqlite VM instructions run between checks of the clock
+CHECK_EVERY_N_STEPS = 1000
+
+class QueryTimeoutError(Exception):
+    def __init__(self, timeout_ms: float, elapsed_ms: float, vm_steps: int):
+        self.timeout_ms = timeout_ms
+        self.elapsed_ms = elapsed_ms
+        self.vm_steps = vm_steps
+        super().__init__(
+            f"SQL took more than {timeout_ms:.0f} ms ({elapsed_ms:.0f} ms, "
+            f"about {vm_steps} VM steps). Marking Invalid."
+        )
+
+    @property
+    def error_msg(self) -> str:
+        "The message written next to a timed out query."
+        return f"(TimeoutError): Took longer than {self.timeout_ms:.0f} ms. Stopped after {self.elapsed_ms:.0f} ms and about {self.vm_steps} VM steps."
+
+def sqlite_connection(conn: Any) -> sqlite3.Connection:
+    """The sqlite3 connection under a records or SQLAlchemy connection.
+    SQLAlchemy's pooled connection passes every call through to it.
+    """
+    if hasattr(conn, '_conn'):
+        # records.Connection wraps a SQLAlchemy Connection
+        conn = conn._conn
+    if hasattr(conn, 'connection'):
+        return conn.connection
+    return conn
+
+@contextmanager
+def query_timeout(conn: Any, timeout_ms: float):
+    """Interrupt the queries run on the connection inside the block once
+    they take longer than timeout_ms milliseconds. A timed out query
+    raises QueryTimeoutError with the elapsed time and the VM steps.
+
+    sqlite calls the progress handler from inside its VM on the thread
+    running the query. Unlike signal.alarm this works from any thread
+    or process and stops a query in the middle of a long C call.
+    """
+    conn = sqlite_connection(conn)
+    state = {'steps': 0, 'timed_out': False}
+    start = time.perf_counter()
+    deadline = start + timeout_ms / 1000
+
+    def handler() -> int:
+        state['steps'] += CHECK_EVERY_N_STEPS
+        if time.perf_counter() > deadline:
+            state['timed_out'] = True
+            return 1
+        return 0
+
+    conn.set_progress_handler(handler, CHECK_EVERY_N_STEPS)
+    try:
+        yield
+    except Exception as e:
+        # sqlite3 or SQLAlchemy raise an OperationalError: interrupted
+        if state['timed_out']:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            raise QueryTimeoutError(timeout_ms, elapsed_ms, state['steps']) from e
+        raise
+    finally:
+        conn.set_progress_handler(None, CHECK_EVERY_N_STEPS)
@@ -0,0 +1,78 @@
+import sqlite3
+import logging
+import threading
+
+from typing import Any, Dict
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from lib.sql_timeout import QueryTimeoutError, query_timeout
+
+logger = logging.getLogger("myLogger")
+
+# execute runs the query. prepare only compiles it with EXPLAIN, which
+# checks the syntax and that every table and column exists without
+# reading any rows. prepare_then_execute runs the queries that compiled.
+VALIDATION_MODES = ('execute', 'prepare', 'prepare_then_execute')
+
+def format_sql_error(error: Exception, query: str) -> str:
+    """The error message of an invalid query. It names the sqlite3 error
+    under a SQLAlchemy error and shows the query that was given, not the
+    EXPLAIN of prepare mode, so the message is the same in every mode.
+    """
+    error = getattr(error, 'orig', None) or error
+    return f"({type(error).__module__}.{type(error).__name__}) {error}\n[SQL: {query}]"
+
+class SQLValidator:
+    """Runs generated queries against their spider sqlite database in
+    a thread pool while generation continues. Every worker thread
+    opens its own read only connection to each database it sees.
+
+    submit returns a future of {'is_valid': bool, 'error_msg': str}
+    with the error messages of format_sql_error like validate_sql.py.
+    """
+    def __init__(
+        self, database_dir: Path, n_workers: int = 4,
+        timeout_ms: float = 10000, mode: str = 'execute'
+    ):
+        if mode not in VALIDATION_MODES:
+            raise ValueError(
+                f"Validation mode {mode} is not valid.",
+                f"Validation mode must be one of {list(VALIDATION_MODES)}."
+            )
+        self.database_dir = database_dir
+        self.timeout_ms = timeout_ms
+        self.mode = mode
+        self._executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='validator')
+        self._local = threading.local()
+
+    def _get_connection(self, db_id: str) -> sqlite3.Connection:
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        if db_id not in self._local.connections:
+            db_path = self.database_dir / db_id / f'{db_id}.sqlite'
+            self._local.connections[db_id] = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        return self._local.connections[db_id]
+
+    def _validate(self, db_id: str, query: str) -> Dict[str, Any]:
+        conn = self._get_connection(db_id)
+        try:
+            with query_timeout(conn, self.timeout_ms):
+                if self.mode != 'execute':
+                    conn.execute(f'EXPLAIN {query}').fetchall()
+                if self.mode != 'prepare':
+                    conn.execute(query).fetchall()
+        except QueryTimeoutError as e:
+            logger.warning(e)
+            return {'is_valid': False, 'error_msg': e.error_msg}
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            error_msg = format_sql_error(e, query)
+            logger.debug(f'Found invalid sql for db: {db_id} query: {query} error: {error_msg}')
+            return {'is_valid': False, 'error_msg': error_msg}
+        return {'is_valid': True, 'error_msg': None}
+
+    def submit(self, db_id: str, query: str) -> Future:
+        return self._executor.submit(self._validate, db_id, query)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,172 @@
+import json
+import math
+import time
+import logging
+import threading
+
+from typing import Any, Dict, Optional
+from pathlib import Path
+from collections import defaultdict
+
+logger = logging.getLogger("myLogger")
+
+SUMMARY_FNAME = "telemetry.json"
+CALLS_FNAME = "telemetry_calls.jsonl"
+
+class LatencyHistogram:
+    """A running histogram with geometric buckets. Every bucket is 10%
+    wider than the one before it so percentiles are within 10% no
+    matter how many values are recorded.
+    """
+    def __init__(self, min_value: float = 1e-3, growth: float = 1.1):
+        self.min_value = min_value
+        self._log_growth = math.log(growth)
+        self._counts = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value: float):
+        bucket = max(0, math.ceil(math.log(max(value, self.min_value) / self.min_value) / self._log_growth))
+        self._counts[bucket] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p: float) -> Optional[float]:
+        """The upper bound of the bucket holding the pth percentile."""
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self._counts):
+            seen += self._counts[bucket]
+            if seen >= rank:
+                return self.min_value * math.exp(bucket * self._log_growth)
+
+class Telemetry:
+    """Collects the latency, tokens and sleeps of every API call.
+
+    Every call is appended to telemetry_calls.jsonl with its labels.
+    Every summary_interval_s seconds a summary with the throughput,
+    latency percentiles, tokens per minute, estimated spend and ETA is
+    logged and written to telemetry.json. Both files are in the run dir.
+    """
+    def __init__(
+        self, output_dir: Path, price_per_1k_tokens: float = 0.0,
+        summary_interval_s: float = 60
+    ):
+        self.output_dir = output_dir
+        self.price_per_1k_tokens = price_per_1k_tokens
+        self.summary_interval_s = summary_interval_s
+        self._lock = threading.Lock()
+        self._calls_file = open(output_dir / CALLS_FNAME, 'a')
+        self._start = time.monotonic()
+        self._last_summary = self._start
+        self.latency = LatencyHistogram()
+        self.n_requests = 0
+        self.n_cached = 0
+        self.n_errors = defaultdict(int)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds_sleeping = defaultdict(float)
+        self.per_label = defaultdict(lambda: defaultdict(float))
+        self.total_requests = None
+
+    def set_total_requests(self, n_requests: int):
+        "The number of requests the run will make. Used for the ETA."
+        self.total_requests = n_requests
+
+    def record_call(
+        self, latency_s: float, prompt_tokens: int, completion_tokens: int,
+        labels: Dict[str, Any], is_new_request: bool = True
+    ):
+        """Record the usage of one prompt. The prompts of a batch share
+        one request so only the first is recorded as a new request.
+        """
+        with self._lock:
+            if is_new_request:
+                self.n_requests += 1
+                self.latency.record(latency_s)
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            db_stats = self.per_label[labels.get('db_id', 'unknown')]
+            db_stats['prompts'] += 1
+            db_stats['tokens'] += prompt_tokens + completion_tokens
+            self._calls_file.write(json.dumps({
+                'time': time.time(), 'latency_s': latency_s,
+                'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'new_request': is_new_request, **labels
+            }) + '\n')
+        self.maybe_report()
+
+    def record_cached(self):
+        with self._lock:
+            self.n_cached += 1
+
+    def record_error(self, kind: str):
+        with self._lock:
+            self.n_errors[kind] += 1
+
+    def record_sleep(self, seconds: float, reason: str):
+        with self._lock:
+            self.seconds_sleeping[reason] += seconds
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = time.monotonic() - self._start
+            total_tokens = self.prompt_tokens + self.completion_tokens
+            requests_per_s = self.n_requests / elapsed if elapsed else 0.0
+            eta_s = None
+            if self.total_requests is not None and requests_per_s:
+                eta_s = max(0, self.total_requests - self.n_requests) / requests_per_s
+            return {
+                'elapsed_s': elapsed,
+                'n_requests': self.n_requests,
+                'n_cached': self.n_cached,
+                'n_errors': dict(self.n_errors),
+                'requests_per_s': requests_per_s,
+                'latency_p50_s': self.latency.percentile(50),
+                'latency_p95_s': self.latency.percentile(95),
+                'latency_p99_s': self.latency.percentile(99),
+                'latency_mean_s': self.latency.total / self.latency.count if self.latency.count else None,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'tokens_per_min': total_tokens / elapsed * 60 if elapsed else 0.0,
+                'estimated_spend': total_tokens / 1000 * self.price_per_1k_tokens,
+                'seconds_in_api': self.latency.total,
+                'seconds_sleeping': dict(self.seconds_sleeping),
+                'total_requests': self.total_requests,
+                'eta_s': eta_s,
+                'per_db': {k: dict(v) for k, v in self.per_label.items()},
+            }
+
+    def maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_summary < self.summary_interval_s:
+            return
+        self._last_summary = now
+        self.report()
+
+    def report(self):
+        summary = self.summary()
+        logger.info(
+            'Telemetry: {} requests ({:.2f}/s) p50/p95/p99 latency: {}/{}/{}s '
+            '{:.0f} tokens/min spend: ${:.2f} sleeping: {} ETA: {}'.format(
+                summary['n_requests'], summary['requests_per_s'],
+                *(_fmt(summary[f'latency_p{p}_s']) for p in (50, 95, 99)),
+                summary['tokens_per_min'], summary['estimated_spend'],
+                {k: round(v, 1) for k, v in summary['seconds_sleeping'].items()},
+                'unknown' if summary['eta_s'] is None else f"{summary['eta_s'] / 60:.1f} min"
+            )
+        )
+        with self._lock:
+            self._calls_file.flush()
+        with open(self.output_dir / SUMMARY_FNAME, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    def close(self):
+        self.report()
+        with self._lock:
+            self._calls_file.close()
+
+def _fmt(value: Optional[float]) -> str:
+    return 'n/a' if value is None else f'{value:.2f}'
@@ -0,0 +1,12 @@
+from typing import List, Union
+
+# The API counts roughly 4 characters of english text per token.
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: Union[str, List[str]]) -> int:
+    """Approximate the number of tokens the API will count for the
+    text. A list of prompts is the sum of every prompt.
+    """
+    if isinstance(text, list):
+        return sum(estimate_tokens(t) for t in text)
+    return len(text) // CHARS_PER_TOKEN + 1
@@ -1,15 +1,54 @@
 import json
+import queue
+import signal
+import threading
 
-from typing import Tuple
+from typing import Any, Dict, Tuple, Optional, TextIO
+from collections import deque
+from concurrent.futures import Future
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from lib.journal import GenerationJournal
+from lib.response_archive import ResponseArchiveWriter
+
+DATA_FORMATS = ('json', 'jsonl')
+EXP_FORMATS = ('files', 'archive')
 
 @dataclass
 class OutputManager:
     exp_time: str
     exp_output_dir: Path
     data_output_dir: Path
+    # When given the journal records the work units as they reach disk
+    journal: Optional[GenerationJournal] = None
+    # jsonl appends one pair per line to a file that stays open.
+    # json rewrites the whole json array for every pair.
+    data_format: str = "jsonl"
+    _data_files: Dict[Path, TextIO] = field(default_factory=dict, init=False, repr=False)
+    # files writes every response and input_output to its own json file.
+    # archive appends them to one compressed file per database.
+    exp_format: str = "archive"
+    archive_compression: str = "gzip"
+    _archives: Dict[str, ResponseArchiveWriter] = field(default_factory=dict, init=False, repr=False)
+    # Total seconds spent in write_output over the whole run
+    seconds_writing: float = field(default=0.0, init=False)
+    # Generation threads share one manager. Only one of them
+    # can write to the data files at a time.
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.data_format not in DATA_FORMATS:
+            raise ValueError(
+                f"Data format {self.data_format} is not valid.",
+                f"Data format must be one of {list(DATA_FORMATS)}."
+            )
+        if self.exp_format not in EXP_FORMATS:
+            raise ValueError(
+                f"Experiment output format {self.exp_format} is not valid.",
+                f"Experiment output format must be one of {list(EXP_FORMATS)}."
+            )
 
     def _make_output_dirs(self, db_name: str) -> Tuple[Path, Path]:
         """Create the output directories. The tuple returned contains
@@ -34,36 +73,166 @@ class OutputManager:
         existing_data.append(data)
         with open(output_fpath, 'w') as f:
             json.dump(existing_data, f, indent=4)
-        
 
-    def write_output(self, queue) -> int:
+    def _resolve_pending(self, data):
+        """Values that are still being computed, like inline validation,
+        are futures of a dictionary. Wait for them and add the result.
+        """
+        for key, value in list(data.items()):
+            if isinstance(value, Future):
+                data.pop(key)
+                data.update(value.result())
+
+    def _append_data_output(self, data, output_fpath: Path):
+        if output_fpath not in self._data_files:
+            self._data_files[output_fpath] = open(output_fpath, 'a')
+        self._data_files[output_fpath].write(json.dumps(data) + '\n')
+
+    def _archive_exp_output(self, db_name: str, output_type: str, itr: str, data, exp_output: Path):
+        if db_name not in self._archives:
+            self._archives[db_name] = ResponseArchiveWriter(exp_output, self.archive_compression)
+        self._archives[db_name].append(output_type, itr, data)
+
+    def _flush_data_files(self):
+        for f in self._data_files.values():
+            f.flush()
+        for archive in self._archives.values():
+            archive.flush()
+
+    def close(self):
+        with self._lock:
+            for f in self._data_files.values():
+                f.close()
+            self._data_files.clear()
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+
+    def write_output(self, queue) -> float:
         """Write all output in the queue to disk.
 
         Args:
             queue (collections.deque): A queue of dictionaries
             with the key is a Tuple[db_name, output_type, itr]
             and the value is a dictionary which should be written
-            to disk as a json obj.
+            to disk as a json obj. The journal output_type marks
+            a finished work unit once everything before it is written.
 
         Returns:
-            int: Number of seconds taken to write output.
+            float: Number of seconds taken to write output.
         """
         start = datetime.now()
-        while queue:
-            data = queue.popleft()
-            # Each data dictionary in the queue should have 1 item
-            (db_name, output_type, itr), val = data.popitem()
-            exp_output, data_output = self._make_output_dirs(db_name)
-            if output_type == 'pair':
-                fpath = data_output / f'{self.exp_time}.json'
-                self._write_data_output(val, fpath)
-            elif output_type in ('response', 'input_output'):
-                fpath = exp_output / f'{output_type}_{itr}.json'
-                self._write_exp_output(val, fpath)
-            else:
-                raise ValueError(
-                    f"Output type {output_type} is not valid.",
-                    "Output_type must be one of [response, input_output, pair]."
-                )
+        with self._lock:
+            while queue:
+                data = queue.popleft()
+                # Each data dictionary in the queue should have 1 item
+                (db_name, output_type, itr), val = data.popitem()
+                if output_type == 'journal':
+                    # The pairs before this unit must be on disk first
+                    self._flush_data_files()
+                    if self.journal is not None:
+                        self.journal.record(val)
+                    continue
+                exp_output, data_output = self._make_output_dirs(db_name)
+                if output_type == 'pair':
+                    self._resolve_pending(val)
+                if output_type == 'pair' and self.data_format == 'jsonl':
+                    fpath = data_output / f'{self.exp_time}.jsonl'
+                    self._append_data_output(val, fpath)
+                elif output_type == 'pair':
+                    fpath = data_output / f'{self.exp_time}.json'
+                    self._write_data_output(val, fpath)
+                elif output_type in ('response', 'input_output') and self.exp_format == 'archive':
+                    self._archive_exp_output(db_name, output_type, itr, val, exp_output)
+                elif output_type in ('response', 'input_output'):
+                    fpath = exp_output / f'{output_type}_{itr}.json'
+                    self._write_exp_output(val, fpath)
+                else:
+                    raise ValueError(
+                        f"Output type {output_type} is not valid.",
+                        "Output_type must be one of [response, input_output, pair, journal]."
+                    )
+            self._flush_data_files()
+            if self.journal is not None:
+                self.journal.sync()
         end = datetime.now()
-        return (end - start).seconds
\ No newline at end of file
+        seconds_spent = (end - start).total_seconds()
+        self.seconds_writing += seconds_spent
+        return seconds_spent
+
+class BackgroundWriter:
+    """Writes output to disk from a background thread while the
+    generation loop keeps running. It can be used in place of the
+    output deque since producers only call append.
+
+    At most max_pending items are held in memory. When the disk falls
+    behind append blocks until the writer catches up. An error in the
+    writer thread is raised by the next call to append, flush or close.
+    """
+    def __init__(self, output_manager: OutputManager, max_pending: int = 1000):
+        self.output_manager = output_manager
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = deque([self._queue.get()])
+            # Write everything that is waiting in one go
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            n_items = len(batch)
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            try:
+                if self._error is None:
+                    self.output_manager.write_output(batch)
+            except Exception as e:
+                self._error = e
+            for _ in range(n_items):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def append(self, item: Dict[Tuple[str, str, str], Any]):
+        self._raise_error()
+        self._queue.put(item)
+
+    def flush(self) -> float:
+        """Block until everything appended so far is on disk.
+
+        Returns:
+            float: Number of seconds spent waiting.
+        """
+        start = datetime.now()
+        self._queue.join()
+        self._raise_error()
+        end = datetime.now()
+        return (end - start).total_seconds()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_error()
+
+# Tells the writer thread to stop after it writes everything before it
+_STOP = object()
+
+def raise_on_sigterm():
+    """Turn SIGTERM into a KeyboardInterrupt so the generation loop
+    writes its output and journal the same way it does on Ctrl-C.
+    Must be called from the main thread.
+    """
+    def _handle_sigterm(signum, frame):
+        raise KeyboardInterrupt(f"Received signal {signum}")
+    signal.signal(signal.SIGTERM, _handle_sigterm)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import hashlib
+import logging
+import contextlib
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from pathlib import Path
+PARENT_DIR = Path(__file__, '../..').resolve()
+sys.path.append(str(PARENT_DIR))
+
+import hydra
+
+from omegaconf import OmegaConf
+
+from lib.data_files import iter_data_file
+
+logger = logging.getLogger("myLogger")
+
+MANIFEST_FNAME = ".merge_manifest.json"
+
+class JsonArrayAppender:
+    """Append records to a json array file without reading it. The
+    closing bracket is cut off, the new records are written and the
+    bracket is written again. Each record is written on its own line.
+    """
+    def __init__(self, fpath: Path, overwrite: bool = False):
+        self.fpath = fpath
+        self.overwrite = overwrite
+        self.n_written = 0
+
+    def __enter__(self) -> 'JsonArrayAppender':
+        if self.overwrite or not self.fpath.exists():
+            self._file = open(self.fpath, 'w')
+            self._file.write('[')
+            self._is_empty = True
+            return self
+
+        self._file = open(self.fpath, 'r+')
+        end = self._file.seek(0, os.SEEK_END)
+        # Walk back over the closing bracket and any whitespace
+        tail_start = max(0, end - 4096)
+        self._file.seek(tail_start)
+        tail = self._file.read()
+        close_idx = tail.rstrip().rfind(']')
+        if close_idx == -1:
+            raise ValueError(f"The file: {self.fpath} is not a json array.")
+        self._is_empty = tail[:close_idx].rstrip().endswith('[')
+        self._file.seek(tail_start + close_idx)
+        self._file.truncate()
+        return self
+
+    def write(self, record: Dict[str, Any]):
+        self._file.write('\n' if self._is_empty else ',\n')
+        self._file.write(json.dumps(record))
+        self._is_empty = False
+        self.n_written += 1
+
+    def __exit__(self, *exc):
+        self._file.write('\n]' if not self._is_empty else ']')
+        self._file.close()
+
+def normalize_pair_key(pair: Dict[str, Any]) -> str:
+    """Pairs are the same if their db, question and query only
+    differ by case, whitespace or a trailing semicolon.
+    """
+    query = pair.get('query', pair.get('gen_sql', ''))
+    parts = [pair.get('db_id', ''), pair.get('question', ''), query]
+    normalized = '\x1f'.join(' '.join(p.lower().split()).rstrip(';').strip() for p in parts)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+def find_run_files(db_dir: Path) -> List[Path]:
+    return sorted(
+        list(db_dir.glob('[0-9]*.json')) + list(db_dir.glob('[0-9]*.jsonl'))
+    )
+
+def iter_jsonl_from(fpath: Path, offset: int) -> Iterator[Tuple[Dict[str, Any], int]]:
+    """Yield the complete lines of a jsonl file after the offset with
+    the offset just past each line. A line that is still being written
+    is left for the next merge.
+    """
+    with open(fpath, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            if line.strip():
+                yield json.loads(line), offset
+
+def plan_database(
+    db_dir: Path, db_manifest: Dict[str, Any], output_fname: str
+) -> Tuple[bool, List[Tuple[Path, int]]]:
+    """Find the run files that have to be read. Returns whether the
+    database must be rebuilt from scratch and the (file, offset) pairs
+    to read. A jsonl file that grew is read from where the last merge
+    stopped. Any other change to a merged file, or to the merged output
+    since the last merge, forces a rebuild.
+    """
+    files = db_manifest['files']
+    run_files = find_run_files(db_dir)
+    rebuild_plan = (True, [(fpath, 0) for fpath in run_files])
+    output_path = db_dir / output_fname
+    output_size = output_path.stat().st_size if output_path.exists() else None
+    if output_size != db_manifest.get('output_size'):
+        return rebuild_plan
+    if set(files) - {fpath.name for fpath in run_files}:
+        return rebuild_plan
+
+    to_read = []
+    for fpath in run_files:
+        stat = fpath.stat()
+        old = files.get(fpath.name)
+        if old is None:
+            to_read.append((fpath, 0))
+        elif (old['size'], old['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        elif fpath.suffix == '.jsonl' and stat.st_size > old['offset']:
+            to_read.append((fpath, old['offset']))
+        else:
+            return rebuild_plan
+    return False, to_read
+
+def iter_new_records(
+    to_read: List[Tuple[Path, int]], db_manifest: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Stream the records of the files to read and update the file
+    entries of the manifest as every file is finished.
+    """
+    for fpath, offset in to_read:
+        stat = fpath.stat()
+        if fpath.suffix == '.jsonl':
+            for record, offset in iter_jsonl_from(fpath, offset):
+                yield record
+        else:
+            yield from iter_data_file(fpath)
+            offset = stat.st_size
+        db_manifest['files'][fpath.name] = {
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'offset': offset
+        }
+
+def dedupe_records(
+    records: Iterable[Dict[str, Any]], seen: set
+) -> Iterator[Dict[str, Any]]:
+    for record in records:
+        key = normalize_pair_key(record)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield record
+
+def iter_database_files(data_dir: Path, db_names: List[str], fname: str) -> Iterator[Dict[str, Any]]:
+    for db_name in db_names:
+        fpath = data_dir / db_name / fname
+        if fpath.exists():
+            yield from iter_data_file(fpath)
+
+def merge_database(
+    db_dir: Path, db_manifest: Dict[str, Any], rebuild: bool,
+    to_read: List[Tuple[Path, int]], cfg, combined: Optional[JsonArrayAppender]
+):
+    """Append the new records of a database to its merged file and
+    to the combined file when it is given.
+    """
+    if rebuild:
+        logger.info(f'Rebuilding {cfg.output_fname} for: {db_dir.name}')
+        db_manifest['files'] = {}
+        db_manifest['seen'] = []
+    seen = set(db_manifest['seen'])
+    records = iter_new_records(to_read, db_manifest)
+    if cfg.dedupe:
+        records = dedupe_records(records, seen)
+    output_path = db_dir / cfg.output_fname
+    with JsonArrayAppender(output_path, overwrite=rebuild) as db_file:
+        for record in records:
+            db_file.write(record)
+            if combined is not None:
+                combined.write(record)
+    db_manifest['seen'] = sorted(seen)
+    db_manifest['output_size'] = output_path.stat().st_size
+    logger.info(f'Merged {db_file.n_written} new pairs for: {db_dir.name} from {len(to_read)} files')
+
+@hydra.main(config_path="configs", config_name="merge", version_base="1.2")
+def main(cfg):
+    logger.info(f'\n{OmegaConf.to_yaml(cfg)}')
+    data_dir = PARENT_DIR / cfg.path_to_data
+    assert data_dir.exists(), f'The path: {data_dir} did not exist.'
+
+    manifest_path = data_dir / MANIFEST_FNAME
+    manifest = {'dedupe': cfg.dedupe, 'databases': {}}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if manifest['dedupe'] != cfg.dedupe:
+        logger.info('The dedupe setting changed since the last merge. Rebuilding everything.')
+        manifest = {'dedupe': cfg.dedupe, 'databases': {}}
+
+    db_names = sorted(d.name for d in data_dir.iterdir() if d.is_dir())
+    plans = {}
+    for db_name in db_names:
+        db_manifest = manifest['databases'].setdefault(db_name, {'files': {}, 'seen': []})
+        plans[db_name] = plan_database(data_dir / db_name, db_manifest, cfg.output_fname)
+
+    # The combined file is grouped by database in the order of db_names
+    # like a rebuild. It can only be appended to if every database was
+    # appended to and no database before the last one in the file has
+    # new pairs. Otherwise it is rebuilt from the database files.
+    combined_path = data_dir / cfg.output_fname
+    combined_size = combined_path.stat().st_size if combined_path.exists() else None
+    last_db_name = manifest.get('combined_last_db')
+    rebuild_combined = (
+        combined_size != manifest.get('combined_size')
+        or any(rebuild for rebuild, _ in plans.values())
+        or any(
+            last_db_name is None or db_name < last_db_name
+            for db_name, (_, to_read) in plans.items() if to_read
+        )
+    )
+    with contextlib.ExitStack() as stack:
+        combined = None
+        if not rebuild_combined:
+            combined = stack.enter_context(JsonArrayAppender(combined_path))
+        for db_name in db_names:
+            rebuild, to_read = plans[db_name]
+            if rebuild or to_read:
+                merge_database(
+                    data_dir / db_name, manifest['databases'][db_name],
+                    rebuild, to_read, cfg, combined
+                )
+
+    if rebuild_combined:
+        logger.info(f'Rebuilding the combined {combined_path}')
+        with JsonArrayAppender(combined_path, overwrite=True) as combined:
+            for record in iter_database_files(data_dir, db_names, cfg.output_fname):
+                combined.write(record)
+    logger.info(f'Wrote {combined.n_written} pairs to {combined_path}')
+
+    # The manifest is written last. If the merge dies before this the
+    # sizes will not match on the next merge and it rebuilds.
+    manifest['combined_size'] = combined_path.stat().st_size
+    manifest['combined_last_db'] = next((
+        db_name for db_name in reversed(db_names)
+        if manifest['databases'][db_name].get('output_size', 0) > len('[]')
+    ), None)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    for fname in cfg.combine_fnames:
+        with JsonArrayAppender(data_dir / fname, overwrite=True) as combined_file:
+            for record in iter_database_files(data_dir, db_names, fname):
+                combined_file.write(record)
+        logger.info(f'Combined {combined_file.n_written} pairs into {data_dir / fname}')
+
+if __name__ == "__main__":
+    main()
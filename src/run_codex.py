@@ -1,16 +1,15 @@
 #!/usr/bin/env python3
 import sys
-import time
+import math
 import logging
 
-from typing import List, Dict
+from typing import Callable, Iterable, Iterator, List, Dict, Sized, Tuple, Optional
 from collections import deque
 from pathlib import Path
 PARENT_DIR = Path(__file__, '../..').resolve()
 sys.path.append(str(PARENT_DIR))
 
 import hydra
-import openai
 
 from omegaconf import OmegaConf
 from openai.error import RateLimitError, ServiceUnavailableError
@@ -19,19 +18,45 @@ from src.config import (
     APIConfig, ExperimentConfig, CodexGenerationConfig,
     get_output_dir, get_exp_time
 )
-from lib.write_output import OutputManager
-from lib.create_few_shot_prompt import generate_codex_prompts
+from lib.write_output import OutputManager, BackgroundWriter, raise_on_sigterm
+from lib.completion_client import CompletionClient
+from lib.journal import GenerationJournal
+from lib.sql_validator import SQLValidator
+from lib.create_few_shot_prompt import PATH_TO_FEW_SHOT, generate_codex_prompts, count_codex_prompts
+from lib.prompt_assembler import prompt_token_budget
+from lib.dry_run import mean_output_tokens, plan_codex_run, add_time_and_cost, log_plan
 
 logger = logging.getLogger("myLogger")
 
-def generate_sql(api_cfg: APIConfig, gen_cfg: CodexGenerationConfig, prompts: List[Dict[str, str]]):
+def generate_sql(
+    api_cfg: APIConfig, gen_cfg: CodexGenerationConfig,
+    prompts: Iterable[Dict[str, str]], resume_dir: Optional[Path] = None,
+    backend: Optional[Callable] = None, n_prompts: Optional[int] = None
+) -> Dict[str, OutputManager]:
+    """Prompts can be a generator. Pass n_prompts so the telemetry
+    knows the number of requests and can show an ETA.
+    """
     data_output_dir = PARENT_DIR / gen_cfg.data_output_dir
-    api_cfg = OmegaConf.to_container(api_cfg)
 
     # Create output manager object to write output to disk
     output_dir = get_output_dir()
+    client = CompletionClient.from_api_cfg(api_cfg, backend, output_dir)
     gpt_response_dir = output_dir / "gpt_input_output"
 
+    # The journal records the index of every prompt that was written
+    journal = GenerationJournal(output_dir)
+    finished = set()
+    if resume_dir is not None:
+        finished = {unit['itr'] for unit in journal.resume_from(resume_dir)}
+
+    validator = None
+    if gen_cfg.inline_validation:
+        validator = SQLValidator(
+            PARENT_DIR / gen_cfg.database_dir,
+            gen_cfg.validation_workers, gen_cfg.validation_timeout_ms,
+            gen_cfg.validation_mode
+        )
+
     exp_time = get_exp_time()
     output_queues = {}
     output_managers = {}
@@ -46,62 +71,115 @@ def generate_sql(api_cfg: APIConfig, gen_cfg: CodexGenerationConfig, prompts: Li
         output_managers[dname] = OutputManager(
             exp_time=exp_time,
             exp_output_dir=new_response_output,
-            data_output_dir=new_data_output
+            data_output_dir=new_data_output,
+            journal=journal,
+            data_format=gen_cfg.data_output_format,
+            exp_format=gen_cfg.response_output_format,
+            archive_compression=gen_cfg.archive_compression
         )
-        output_queues[dname] = deque()
+        if gen_cfg.background_writer:
+            output_queues[dname] = BackgroundWriter(output_managers[dname], gen_cfg.max_pending_output)
+        else:
+            output_queues[dname] = deque()
 
-    def call_model(prompt: str, db_name: str, dataset_name: str, itr: int):
-        response = openai.Completion.create(
-            prompt=prompt['text'],
-            **api_cfg
+    def call_model(batch: List[Tuple[int, Dict[str, str]]]):
+        # Every prompt in the batch gets its own response back so the
+        # output is the same as calling the model one prompt at a time.
+        responses = client.create_batch(
+            [prompt['text'] for _, prompt in batch],
+            [
+                {'db_id': prompt['db_id'], 'dataset_name': prompt['dataset_name'], 'itr': itr}
+                for itr, prompt in batch
+            ]
         )
-        output_queues[dataset_name].append({(db_name, 'response', itr): response})
-        results = parse_response(response)
-        for i, result in enumerate(results):
-            result['input'] = prompt['text']
-            # Every iteration might have multiple generations.
-            # So we save them under a different iteration name
-            output_queues[dataset_name].append({(db_name, 'input_output', f'{itr}_{i}'): result})
-            # Save the question query pair directly to the data dir
-            new_prompt = prompt.copy()
-            new_prompt['gen_sql'] = result['gen_sql']
-            new_prompt['n_generation'] = i
-            # output_queues[dataset_name].append({(db_name, 'pair', f'{itr}_{i}'): prompt})
-            output_queues[dataset_name].append({(db_name, 'pair', f'{itr}_{i}'): new_prompt})
+        for (itr, prompt), response in zip(batch, responses):
+            db_name = prompt['db_id']
+            dataset_name = prompt['dataset_name']
+            output_queues[dataset_name].append({(db_name, 'response', itr): response})
+            results = parse_response(response)
+            for i, result in enumerate(results):
+                result['input'] = prompt['text']
+                # Every iteration might have multiple generations.
+                # So we save them under a different iteration name
+                output_queues[dataset_name].append({(db_name, 'input_output', f'{itr}_{i}'): result})
+                # Save the question query pair directly to the data dir
+                new_prompt = prompt.copy()
+                new_prompt['gen_sql'] = result['gen_sql']
+                new_prompt['n_generation'] = i
+                if validator is not None:
+                    new_prompt['validation'] = validator.submit(db_name, result['gen_sql'])
+                # output_queues[dataset_name].append({(db_name, 'pair', f'{itr}_{i}'): prompt})
+                output_queues[dataset_name].append({(db_name, 'pair', f'{itr}_{i}'): new_prompt})
+            output_queues[dataset_name].append({(db_name, 'journal', itr): {'itr': itr}})
+
+    def write_all_output() -> float:
+        seconds_spent = 0
+        for dname in gen_cfg.input_data_files:
+            if gen_cfg.background_writer:
+                seconds_spent += output_queues[dname].flush()
+            else:
+                seconds_spent += output_managers[dname].write_output(output_queues[dname])
+        return seconds_spent
+
+    def close_all_output():
+        write_all_output()
+        for dname in gen_cfg.input_data_files:
+            if gen_cfg.background_writer:
+                output_queues[dname].close()
+            output_managers[dname].close()
+        if validator is not None:
+            validator.close()
+        journal.close()
+        client.close()
 
+    # Prompts are read as the batches are sent so the number of
+    # requests comes from n_prompts unless the prompts are a list.
+    if n_prompts is None and isinstance(prompts, Sized):
+        n_prompts = len(prompts)
+    if n_prompts is not None:
+        n_requests = math.ceil(max(0, n_prompts - len(finished)) / gen_cfg.batch_size)
+        client.telemetry.set_total_requests(n_requests)
+    indexed_prompts = (
+        (itr, prompt) for itr, prompt in enumerate(prompts)
+        if itr not in finished
+    )
     try:
-        for itr, prompt in enumerate(prompts):
-            db_name = prompt['db_id']
-            dataset_name = prompt["dataset_name"]
-            logger.info(f'Generating for dataset: {dataset_name} and db: {db_name}')
+        for batch in iter_batches(indexed_prompts, gen_cfg.batch_size):
+            for _, prompt in batch:
+                logger.info(f'Generating for dataset: {prompt["dataset_name"]} and db: {prompt["db_id"]}')
             try:
-                call_model(prompt, db_name, dataset_name, itr)
+                call_model(batch)
             except RateLimitError as e:
                 if str(e) == "You exceeded your current quota, please check your plan and billing details.":
                     logger.error('We ran out of tokens :(')
                     raise e
                 logger.error('We have hit our rate limit. Writing output then sleeping.')
-                output_queue = output_queues[dataset_name]
-                output_manager = output_managers[dataset_name]
-                seconds_spent = output_manager.write_output(output_queue)
+                seconds_spent = write_all_output()
                 logger.debug(f'Spent: {seconds_spent} seconds writing output')
-                time.sleep(90 - seconds_spent)
-                call_model(prompt, db_name, dataset_name, itr)
+                client.backoff(max(0, gen_cfg.rate_limit_sleep_seconds - seconds_spent), 'rate_limit_error')
+                call_model(batch)
             except ServiceUnavailableError as e:
                 logger.error(e)
                 logger.error('The service is unavailable sleeping for a minute.')
-                time.sleep(600)
-                call_model(prompt, db_name, dataset_name, itr)
+                client.backoff(gen_cfg.service_unavailable_sleep_seconds, 'service_unavailable')
+                call_model(batch)
 
-    except Exception as e:
-        for dname in gen_cfg.input_data_files:
-            output_managers[dataset_name].write_output(output_queues[dataset_name])
+    except (Exception, KeyboardInterrupt) as e:
+        close_all_output()
         raise e
-    
-    # FIXME: Related to the TODO above. This should be easier
-    # We must iterate through the output queue to find the proper manager
-    for dname in gen_cfg.input_data_files:
-        output_managers[dataset_name].write_output(output_queues[dataset_name])
+
+    close_all_output()
+    return output_managers
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def parse_response(response: Dict[str, str]) -> List[Dict[str, str]]:
     responses = []
@@ -127,11 +205,27 @@ def parse_response(response: Dict[str, str]) -> List[Dict[str, str]]:
 @hydra.main(config_path="configs", config_name="codex", version_base="1.2")
 def main(cfg: ExperimentConfig):
     logger.info(OmegaConf.to_yaml(cfg))
+    raise_on_sigterm()
     
-    prompts = generate_codex_prompts(cfg.generation_cfg)
+    prompts = generate_codex_prompts(
+        cfg.generation_cfg, prompt_token_budget(cfg.api_cfg, cfg.generation_cfg)
+    )
 
-    logger.info(f'Generating {len(prompts)} sql queries.')
-    generate_sql(cfg.api_cfg, cfg.generation_cfg, prompts)
+    logger.info(f'Generating sql queries for: {list(cfg.generation_cfg.input_data_files)}')
+    if cfg.dry_run:
+        gen_cfg = cfg.generation_cfg
+        output_tokens = mean_output_tokens(
+            PATH_TO_FEW_SHOT / gen_cfg.meta_few_shot_file, gen_cfg.query_prefix, style='codex'
+        )
+        plan = plan_codex_run(cfg.api_cfg, gen_cfg, (prompt['text'] for prompt in prompts), output_tokens)
+        # Batches are sent one after another
+        log_plan(add_time_and_cost(plan, cfg.api_cfg, cfg.dry_run_latency_seconds, concurrency=1))
+        return
+    resume_dir = PARENT_DIR / cfg.resume if cfg.resume else None
+    generate_sql(
+        cfg.api_cfg, cfg.generation_cfg, prompts, resume_dir,
+        n_prompts=count_codex_prompts(cfg.generation_cfg)
+    )
     
 if __name__ == '__main__':
     main()
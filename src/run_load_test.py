@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import logging
+
+from pathlib import Path
+PARENT_DIR = Path(__file__, '../..').resolve()
+sys.path.append(str(PARENT_DIR))
+
+import hydra
+import numpy as np
+
+from omegaconf import OmegaConf
+
+import gen_sql
+import run_codex
+
+from src.config import LoadTestConfig, get_output_dir
+from lib.mock_completion import MockCompletion
+from lib.prompt_assembler import prompt_token_budget
+from lib.create_few_shot_prompt import (
+    PATH_TO_FEW_SHOT, generate_prompts, generate_codex_prompts, count_codex_prompts
+)
+
+logger = logging.getLogger("myLogger")
+
+@hydra.main(config_path="configs", config_name="load_test", version_base="1.2")
+def main(cfg: LoadTestConfig):
+    """Drive the real generation loop against the mock backend and
+    report the throughput, latency and output writing overhead.
+    """
+    logger.info(OmegaConf.to_yaml(cfg))
+    gen_cfg = cfg.generation_cfg
+    is_codex = 'input_data_files' in gen_cfg
+
+    mock = MockCompletion(
+        PATH_TO_FEW_SHOT / gen_cfg.meta_few_shot_file,
+        style='codex' if is_codex else 'gpt',
+        query_prefix=gen_cfg.query_prefix,
+        **OmegaConf.to_container(cfg.mock)
+    )
+    latencies = []
+    def timed_backend(**kwargs):
+        start = time.perf_counter()
+        try:
+            return mock.create(**kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if is_codex:
+        prompts = generate_codex_prompts(gen_cfg, prompt_token_budget(cfg.api_cfg, gen_cfg))
+        output_managers = run_codex.generate_sql(
+            cfg.api_cfg, gen_cfg, prompts, backend=timed_backend,
+            n_prompts=count_codex_prompts(gen_cfg)
+        ).values()
+    else:
+        prompts = generate_prompts(gen_cfg, prompt_token_budget(cfg.api_cfg, gen_cfg))
+        output_managers = [gen_sql.generate_sql(
+            cfg.api_cfg, gen_cfg, prompts, backend=timed_backend
+        )]
+    wall_seconds = time.perf_counter() - start
+
+    seconds_writing = sum(m.seconds_writing for m in output_managers)
+    report = {
+        'n_requests': mock.n_calls,
+        'n_injected_errors': mock.n_errors,
+        'wall_seconds': wall_seconds,
+        'requests_per_second': mock.n_calls / wall_seconds,
+        'latency_p50_s': float(np.percentile(latencies, 50)),
+        'latency_p95_s': float(np.percentile(latencies, 95)),
+        'latency_p99_s': float(np.percentile(latencies, 99)),
+        'latency_max_s': max(latencies),
+        'seconds_writing_output': seconds_writing,
+        'write_fraction_of_wall': seconds_writing / wall_seconds,
+    }
+    logger.info('Load test results:\n' + '\n'.join(f'{k}: {v}' for k, v in report.items()))
+    with open(get_output_dir() / 'load_test.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main()
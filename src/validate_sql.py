@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
+import os
 import sys
 import json
-import signal
 import logging
 
 from pathlib import Path
@@ -14,73 +14,139 @@ import records
 # catch sql exceptions from invalid queries
 import sqlalchemy
 
+from typing import Any, Dict, List, Optional, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 from omegaconf import OmegaConf
 
+from lib.sql_timeout import QueryTimeoutError, query_timeout
+from lib.sql_validator import VALIDATION_MODES, format_sql_error
+
 logger = logging.getLogger("myLogger")
 
-class TimeoutError(Exception):
-    pass
+def make_query_call(conn, query, timeout_ms: float, mode: str = 'execute'):
+    """prepare only compiles the query with EXPLAIN. Compiling fails
+    with the same errors as running for bad syntax and missing tables
+    or columns but never reads a row.
+    """
+    with query_timeout(conn, timeout_ms):
+        if mode != 'execute':
+            conn.query(f'EXPLAIN {query}')
+        if mode != 'prepare':
+            conn.query(query)
 
-def timeout(func):
-    def _handle_timeout(signum, frame):
-        raise TimeoutError("SQL took more than 10 seconds. Marking Invalid.")
-    def wrapper(*a, **kw):
-        signal.signal(signal.SIGALRM, _handle_timeout)
-        signal.alarm(10)
-        try:
-            result = func(*a, **kw)
-        finally:
-            signal.alarm(0)
-        return result
-    return wrapper
+# Every worker process keeps one connection per database
+_connections = {}
 
-@timeout
-def make_query_call(conn, query):
-    conn.query(query)
+def get_connection(db_path: Path):
+    if db_path not in _connections:
+        db = records.Database(f'sqlite:///{db_path}')
+        _connections[db_path] = db.get_connection()
+    return _connections[db_path]
+
+def validate_chunk(
+    db_path: Path, pairs: List[Dict[str, Any]], timeout_ms: float, mode: str
+) -> Tuple[List[Optional[str]], bool, int]:
+    """Run every query of the chunk. Returns the error message of every
+    query that ran (None when it is valid), whether an unexpected
+    exception stopped the chunk early and the pid of the worker.
+    """
+    conn = get_connection(db_path)
+    error_msgs = []
+    for pair in pairs:
+        try:
+            key = 'query' if 'query' in pair else 'gen_sql'
+            # conn.query(pair[key])
+            make_query_call(conn, pair[key], timeout_ms, mode)
+        except (sqlalchemy.exc.OperationalError,
+                sqlalchemy.exc.ResourceClosedError) as e:
+            logger.info('Found invalid sql')
+            error_msgs.append(format_sql_error(e, pair[key]))
+        except QueryTimeoutError as e:
+            logger.warning(e)
+            error_msgs.append(e.error_msg)
+        except Exception as e:
+            logger.error(f'There was an unexpected exception: {e}')
+            logger.error(f'I am the db: {pair["db_id"]}')
+            logger.error(f'I am the query {pair[key]}')
+            logger.error(f'I am the question {pair["question"]}')
+            # raise e
+            return error_msgs, True, os.getpid()
+        else:
+            error_msgs.append(None)
+    return error_msgs, False, os.getpid()
 
 @hydra.main(config_path="configs", config_name="validate", version_base="1.2")
 def main(cfg):
     logger.info(f'\n{OmegaConf.to_yaml(cfg)}')
+    if cfg.mode not in VALIDATION_MODES:
+        raise ValueError(
+            f"Validation mode {cfg.mode} is not valid.",
+            f"Validation mode must be one of {list(VALIDATION_MODES)}."
+        )
     gen_data_path = PARENT_DIR / cfg.path_to_data
-    for gen_data_dir in gen_data_path.iterdir():
+    path_to_db = PARENT_DIR / cfg.path_to_database
+
+    # Every database is split into chunks of queries so a large
+    # database is spread over the workers as well.
+    gen_data = {}
+    chunks = []
+    for gen_data_dir in sorted(gen_data_path.iterdir()):
         if gen_data_dir.is_file():
             continue
-        logger.info(f'Testing generations for: {gen_data_dir}')
         db_name = gen_data_dir.name
         with open(gen_data_dir / cfg.input_fname) as f:
-            gen_data = json.load(f)
+            gen_data[gen_data_dir] = json.load(f)
+        db_path = path_to_db / db_name / f'{db_name}.sqlite'
+        for start in range(0, len(gen_data[gen_data_dir]), cfg.chunk_size):
+            chunks.append((gen_data_dir, start, db_path))
+    logger.info(f'Validating {sum(map(len, gen_data.values()))} queries from {len(gen_data)} databases in {len(chunks)} chunks')
+
+    results = {}
+    progress = defaultdict(int)
+    def report(chunk, result):
+        results[chunk[:2]] = result
+        error_msgs, _, pid = result
+        progress[pid] += len(error_msgs)
+        logger.info(
+            f'Worker {pid} validated {len(error_msgs)} queries for: {chunk[0].name}. '
+            f'{len(results)} of {len(chunks)} chunks done. Queries per worker: {dict(progress)}'
+        )
 
-        path_to_db = PARENT_DIR / cfg.path_to_database
-        db = records.Database(f'sqlite:///{path_to_db}/{db_name}/{db_name}.sqlite')
-        conn = db.get_connection()
+    def chunk_pairs(chunk):
+        gen_data_dir, start, _ = chunk
+        return gen_data[gen_data_dir][start:start + cfg.chunk_size]
 
+    if cfg.workers > 1:
+        with ProcessPoolExecutor(max_workers=cfg.workers) as executor:
+            futures = {
+                executor.submit(validate_chunk, chunk[2], chunk_pairs(chunk), cfg.timeout_ms, cfg.mode): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                report(futures[future], future.result())
+    else:
+        for chunk in chunks:
+            report(chunk, validate_chunk(chunk[2], chunk_pairs(chunk), cfg.timeout_ms, cfg.mode))
+
+    # Merge the chunks of every database back in order. An unexpected
+    # exception ends the database at that query like a serial run does.
+    for gen_data_dir, pairs in gen_data.items():
         valid_sql = []
         invalid_sql = []
-        for i, pair in enumerate(gen_data):
-            logger.debug(f'I am the ith iteration: {i}')
-            try:
-                key = 'query' if 'query' in pair else 'gen_sql'
-                # conn.query(pair[key])
-                make_query_call(conn, pair[key])
-            except (sqlalchemy.exc.OperationalError,
-                    sqlalchemy.exc.ResourceClosedError) as e:
-                logger.info('Found invalid sql')
-                pair['error_msg'] = str(e)
-                invalid_sql.append(pair)
-            except TimeoutError as e:
-                logger.warning(e)
-                pair['error_msg'] = "(TimeoutError): Took longer than 10 seconds."
-                invalid_sql.append(pair)
-            except Exception as e:
-                logger.error(f'There was an unexpected exception: {e}')
-                logger.error(f'I am the db: {pair["db_id"]}')
-                logger.error(f'I am the query {pair[key]}')
-                logger.error(f'I am the question {pair["question"]}')
-                # raise e
+        for start in range(0, len(pairs), cfg.chunk_size):
+            error_msgs, stopped, _ = results[(gen_data_dir, start)]
+            for pair, error_msg in zip(pairs[start:], error_msgs):
+                if error_msg is None:
+                    valid_sql.append(pair)
+                else:
+                    pair['error_msg'] = error_msg
+                    invalid_sql.append(pair)
+            if stopped:
                 break
-            else:
-                valid_sql.append(pair)
-        
+        logger.info(f'Found {len(invalid_sql)} invalid of {len(valid_sql) + len(invalid_sql)} queries for: {gen_data_dir.name}')
+
         with open(gen_data_dir / cfg.valid_output_fname, 'w') as f:
             json.dump(valid_sql, f, indent=4)
 
@@ -88,4 +154,4 @@ def main(cfg):
             json.dump(invalid_sql, f, indent=4)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
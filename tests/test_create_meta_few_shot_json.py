@@ -0,0 +1,49 @@
+import re
+import sys
+import json
+import sqlite3
+
+import pytest
+
+from pathlib import Path
+# The script imports evaluation and process_sql from its own dir
+sys.path.insert(0, str(Path(__file__, '../../src/lib').resolve()))
+
+import process_sql
+import create_meta_few_shot_json as meta
+
+PAIRS = [
+    {'db_id': 'concert_singer', 'question': 'How many singers are there?', 'query': 'SELECT count(*) FROM singer'},
+    {'db_id': 'concert_singer', 'question': 'What is the age?', 'query': 'SELECT age FROM singer'},
+]
+
+@pytest.fixture
+def spider_dir(tmp_path, monkeypatch):
+    db_dir = tmp_path / 'spider' / 'database' / 'concert_singer'
+    db_dir.mkdir(parents=True)
+    conn = sqlite3.connect(db_dir / 'concert_singer.sqlite')
+    conn.execute('CREATE TABLE singer (singer_id int PRIMARY KEY, name text)')
+    conn.close()
+    (tmp_path / 'spider' / 'dev.json').write_text(json.dumps(PAIRS))
+    monkeypatch.setattr(meta, 'PATH_TO_SPIDER', tmp_path / 'spider')
+    monkeypatch.setattr(meta, 'PATH_TO_DATABASE', tmp_path / 'spider' / 'database')
+    monkeypatch.chdir(tmp_path)
+    # Queries this simple do not need the nltk punkt model
+    monkeypatch.setattr(process_sql, 'word_tokenize', lambda text: re.findall(r"\w+|[^\w\s]", text))
+    return tmp_path
+
+def test_parse_failures_are_recorded(spider_dir):
+    meta.main(fnames=['dev.json'])
+    grouped = json.loads((spider_dir / meta.OUTPUT_FNAME).read_text())
+    manifest = json.loads((spider_dir / 'grouped_questions.manifest.json').read_text())
+    assert grouped['concert_singer'] == {'easy': [{k: PAIRS[0][k] for k in ('question', 'query')}]}
+    assert [failure['question'] for failure in manifest['concert_singer']['failures']] == ['What is the age?']
+
+def test_other_errors_stop_the_build(spider_dir, monkeypatch):
+    def missing_model(schema, query):
+        raise LookupError('Resource punkt not found.')
+    monkeypatch.setattr(meta, 'get_sql', missing_model)
+    with pytest.raises(LookupError):
+        meta.main(fnames=['dev.json'])
+    assert not (spider_dir / meta.OUTPUT_FNAME).exists()
+    assert not (spider_dir / 'grouped_questions.manifest.json').exists()
@@ -0,0 +1,63 @@
+import sys
+import json
+import sqlite3
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+sys.path.append(str(SRC_DIR.parent))
+
+from omegaconf import OmegaConf
+
+import gen_sql
+
+from src.config import APIConfig, GenerationConfig
+from lib.data_files import iter_data_file
+from lib.mock_completion import MockCompletion
+
+# The mock always answers with this query and the singer table has no age
+META_FEW_SHOT = {
+    'concert_singer': {
+        'easy': [{'question': 'How old are the singers?', 'query': 'SELECT age FROM singer'}],
+    },
+}
+
+def test_regenerate_stops_at_a_duplicate(tmp_path, monkeypatch):
+    monkeypatch.setattr(gen_sql, 'get_output_dir', lambda: tmp_path / 'experiment')
+    monkeypatch.setattr(gen_sql, 'get_exp_time', lambda: 'test')
+    (tmp_path / 'experiment').mkdir()
+    (tmp_path / 'data').mkdir()
+    db_dir = tmp_path / 'database' / 'concert_singer'
+    db_dir.mkdir(parents=True)
+    conn = sqlite3.connect(db_dir / 'concert_singer.sqlite')
+    conn.execute('CREATE TABLE singer (singer_id int PRIMARY KEY, name text)')
+    conn.close()
+    meta_few_shot_path = tmp_path / 'grouped_questions.json'
+    meta_few_shot_path.write_text(json.dumps(META_FEW_SHOT))
+    mock = MockCompletion(meta_few_shot_path, latency_distribution='constant', latency_mean_s=0.0)
+
+    api_cfg = OmegaConf.structured(APIConfig(model='text-davinci-003'))
+    gen_cfg = OmegaConf.structured(GenerationConfig(
+        data_output_dir=str(tmp_path / 'data'),
+        database_dir=str(tmp_path / 'database'),
+        n_generations_per_database=2,
+        inline_validation=True,
+        invalid_action='regenerate',
+        max_regenerations=2,
+        dedupe_queries=True,
+    ))
+    db_prompts = {'concert_singer': [
+        {'prompt': 'Question:', 'text': 'prompt', 'difficulty_of_few_shot': 'easy'},
+    ]}
+    gen_sql.generate_sql(api_cfg, gen_cfg, db_prompts, backend=mock.create)
+
+    # The first query is invalid. Its regeneration and the second
+    # generation are duplicates, which are dropped.
+    assert mock.n_calls == 3
+    pairs = [
+        pair
+        for fpath in (tmp_path / 'data' / 'concert_singer').glob('*.json*')
+        for pair in iter_data_file(fpath)
+    ]
+    assert len(pairs) == 1
+    assert not pairs[0]['is_valid']
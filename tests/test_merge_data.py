@@ -0,0 +1,39 @@
+import sys
+import json
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+
+from omegaconf import OmegaConf
+
+import merge_data
+
+def _write_run(data_dir, db_name, run_name, questions):
+    db_dir = data_dir / db_name
+    db_dir.mkdir(exist_ok=True)
+    pairs = [{'db_id': db_name, 'question': q, 'query': f'SELECT {q}'} for q in questions]
+    (db_dir / f'{run_name}.jsonl').write_text(''.join(json.dumps(pair) + '\n' for pair in pairs))
+
+def _merge(data_dir):
+    merge_data.main(OmegaConf.create({
+        'path_to_data': str(data_dir), 'output_fname': 'all_data.json',
+        'dedupe': True, 'combine_fnames': [],
+    }))
+    return [pair['question'] for pair in json.loads((data_dir / 'all_data.json').read_text())]
+
+def test_combined_file_stays_grouped_by_database(tmp_path):
+    _write_run(tmp_path, 'db1', '01', ['a'])
+    _write_run(tmp_path, 'db2', '01', ['b'])
+    assert _merge(tmp_path) == ['a', 'b']
+
+    # New pairs of the last database are appended
+    _write_run(tmp_path, 'db2', '02', ['c'])
+    assert _merge(tmp_path) == ['a', 'b', 'c']
+
+    # New pairs of an earlier database go before the later databases
+    _write_run(tmp_path, 'db1', '02', ['d'])
+    assert _merge(tmp_path) == ['a', 'd', 'b', 'c']
+
+    (tmp_path / '.merge_manifest.json').unlink()
+    assert _merge(tmp_path) == ['a', 'd', 'b', 'c']
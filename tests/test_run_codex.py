@@ -0,0 +1,68 @@
+import sys
+import json
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+sys.path.append(str(SRC_DIR.parent))
+
+from omegaconf import OmegaConf
+
+import run_codex
+
+from src.config import APIConfig, CodexGenerationConfig
+from lib.data_files import iter_data_file
+from lib.mock_completion import MockCompletion
+from lib.telemetry import SUMMARY_FNAME
+
+META_FEW_SHOT = {
+    'concert_singer': {
+        'easy': [{'question': 'How many singers are there?', 'query': 'SELECT count(*) FROM singer'}],
+    },
+}
+
+def _configs(tmp_path):
+    api_cfg = OmegaConf.structured(APIConfig(model='code-davinci-002'))
+    gen_cfg = OmegaConf.structured(CodexGenerationConfig(
+        data_output_dir=str(tmp_path / 'data'),
+        input_data_files={'spider_dev': 'unused.json'},
+        background_writer=True,
+        batch_size=2,
+    ))
+    return api_cfg, gen_cfg
+
+def _prompts(n_prompts):
+    return (
+        {'text': f'prompt {i}', 'db_id': 'concert_singer', 'dataset_name': 'spider_dev'}
+        for i in range(n_prompts)
+    )
+
+def _mock(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_codex, 'get_output_dir', lambda: tmp_path / 'experiment')
+    monkeypatch.setattr(run_codex, 'get_exp_time', lambda: 'test')
+    (tmp_path / 'experiment').mkdir()
+    meta_few_shot_path = tmp_path / 'grouped_questions.json'
+    meta_few_shot_path.write_text(json.dumps(META_FEW_SHOT))
+    return MockCompletion(meta_few_shot_path, style='codex', latency_distribution='constant', latency_mean_s=0.0)
+
+def test_generate_sql_with_background_writer(tmp_path, monkeypatch):
+    mock = _mock(tmp_path, monkeypatch)
+    api_cfg, gen_cfg = _configs(tmp_path)
+    run_codex.generate_sql(api_cfg, gen_cfg, list(_prompts(5)), backend=mock.create)
+
+    assert mock.n_calls == 3
+    pairs = [
+        pair
+        for fpath in (tmp_path / 'data' / 'spider_dev' / 'concert_singer').glob('*.json*')
+        for pair in iter_data_file(fpath)
+    ]
+    assert len(pairs) == 5
+    assert {pair['gen_sql'] for pair in pairs} == {'SELECT count(*) FROM singer'}
+
+def test_generate_sql_sets_total_requests_for_a_generator(tmp_path, monkeypatch):
+    mock = _mock(tmp_path, monkeypatch)
+    api_cfg, gen_cfg = _configs(tmp_path)
+    run_codex.generate_sql(api_cfg, gen_cfg, _prompts(5), backend=mock.create, n_prompts=5)
+
+    summary = json.loads((tmp_path / 'experiment' / SUMMARY_FNAME).read_text())
+    assert summary['total_requests'] == 3
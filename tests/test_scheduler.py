@@ -0,0 +1,25 @@
+import sys
+import json
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+
+from lib.scheduler import count_valid_pairs
+
+PAIRS = [
+    {'question': 'q1', 'query': 'SELECT 1'},
+    {'question': 'q2', 'query': 'SELECT 2'},
+    {'question': 'q3', 'query': 'SELECT 3', 'is_valid': True},
+    {'question': 'q4', 'query': 'SELECT 4', 'is_valid': False},
+]
+
+def test_count_valid_pairs_only_counts_validated_pairs(tmp_path):
+    db_dir = tmp_path / 'concert_singer'
+    db_dir.mkdir()
+    (db_dir / '01_01_2023.jsonl').write_text(''.join(json.dumps(pair) + '\n' for pair in PAIRS))
+    assert count_valid_pairs(tmp_path, ['concert_singer']) == {'concert_singer': 1}
+
+    # validate_sql.py found q1 valid. q4 stays invalid since inline validation wins.
+    (db_dir / 'syntax_correct_data.json').write_text(json.dumps([PAIRS[0], PAIRS[3]]))
+    assert count_valid_pairs(tmp_path, ['concert_singer']) == {'concert_singer': 2}
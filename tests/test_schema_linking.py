@@ -0,0 +1,47 @@
+import sys
+import sqlite3
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+
+from lib.schema_linking import SchemaLinker, get_foreign_keys, get_key_columns
+
+SCHEMA = (
+    "singer(singer_id, name, age, country)\n"
+    "concert(concert_id, concert_name, year)\n"
+    "singer_in_concert(concert_id, singer_id)\n"
+    "stadium(stadium_id, location)\n"
+)
+
+def _linker(tmp_path):
+    db_path = tmp_path / 'concert_singer.sqlite'
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE singer (singer_id int PRIMARY KEY, name text, age int, country text);
+        CREATE TABLE concert (concert_id int PRIMARY KEY, concert_name text, year int);
+        CREATE TABLE singer_in_concert (
+            concert_id int REFERENCES concert(concert_id),
+            singer_id int REFERENCES singer(singer_id)
+        );
+        CREATE TABLE stadium (stadium_id int PRIMARY KEY, location text);
+    """)
+    conn.close()
+    return SchemaLinker(SCHEMA, get_foreign_keys(db_path), get_key_columns(db_path))
+
+def test_prune_columns_keeps_underscore_keys(tmp_path):
+    schema, _ = _linker(tmp_path).prune('What is the name and age of every singer?', prune_columns=True)
+    assert schema == (
+        "singer(singer_id, name, age)\n"
+        "concert(concert_id, concert_name)\n"
+        "singer_in_concert(concert_id, singer_id)\n"
+    )
+
+def test_prune_columns_matches_every_word_of_a_column(tmp_path):
+    schema, _ = _linker(tmp_path).prune('List the name of every concert.', prune_columns=True)
+    assert "concert(concert_id, concert_name)\n" in schema
+
+def test_prune_tables_only(tmp_path):
+    schema, stats = _linker(tmp_path).prune('How many stadiums are there?')
+    assert schema == "stadium(stadium_id, location)\n"
+    assert stats['pruned_schema_tokens'] < stats['schema_tokens']
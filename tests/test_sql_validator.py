@@ -0,0 +1,43 @@
+import sys
+import sqlite3
+
+import pytest
+
+from pathlib import Path
+SRC_DIR = Path(__file__, '../../src').resolve()
+sys.path.append(str(SRC_DIR))
+sys.path.append(str(SRC_DIR.parent))
+
+from validate_sql import validate_chunk
+from lib.sql_validator import VALIDATION_MODES, SQLValidator
+
+QUERIES = ['SELECT age FROM singer', 'SELEC name FROM singer', 'SELECT name FROM singer']
+
+@pytest.fixture
+def database_dir(tmp_path):
+    (tmp_path / 'concert_singer').mkdir()
+    conn = sqlite3.connect(tmp_path / 'concert_singer' / 'concert_singer.sqlite')
+    conn.execute('CREATE TABLE singer (singer_id int PRIMARY KEY, name text)')
+    conn.close()
+    return tmp_path
+
+def _inline_error_msgs(database_dir, mode):
+    validator = SQLValidator(database_dir, n_workers=1, mode=mode)
+    try:
+        return [validator.submit('concert_singer', query).result()['error_msg'] for query in QUERIES]
+    finally:
+        validator.close()
+
+def test_error_msgs_do_not_depend_on_the_mode_or_validator(database_dir):
+    db_path = database_dir / 'concert_singer' / 'concert_singer.sqlite'
+    pairs = [{'db_id': 'concert_singer', 'question': '', 'query': query} for query in QUERIES]
+    expected = [
+        '(sqlite3.OperationalError) no such column: age\n[SQL: SELECT age FROM singer]',
+        '(sqlite3.OperationalError) near "SELEC": syntax error\n[SQL: SELEC name FROM singer]',
+        None,
+    ]
+    for mode in VALIDATION_MODES:
+        error_msgs, stopped, _ = validate_chunk(db_path, pairs, 10000, mode)
+        assert not stopped
+        assert error_msgs == expected
+        assert _inline_error_msgs(database_dir, mode) == expected